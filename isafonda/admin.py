@@ -5,9 +5,105 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator, InvalidPage
+from django.db import connections
 
-from isafonda.models import Project, StalledRequest
+from isafonda.models import (Project, StalledRequest, DrainLease,
+                             DeliveryAttempt)
+
+
+def estimated_count(queryset):
+    """ planner's row estimate for unfiltered large tables, exact otherwise """
+    conn = connections[queryset.db]
+    if conn.vendor == 'postgresql' and not queryset.query.where:
+        cursor = conn.cursor()
+        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s",
+                       [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+        if row is not None \
+                and row[0] >= settings.ADMIN_ESTIMATED_COUNT_THRESHOLD:
+            return int(row[0])
+    return queryset.count()
+
+
+class EstimatedCountPaginator(Paginator):
+
+    @property
+    def count(self):
+        if getattr(self, '_estimated_count', None) is None:
+            self._estimated_count = estimated_count(self.object_list)
+        return self._estimated_count
+
+
+class EstimatedCountChangeList(ChangeList):
+    """ ChangeList.get_results() counting both filtered and total rows
+        through estimated_count() (Django < 1.8 has no
+        show_full_result_count and always counts the whole table) """
+
+    def get_results(self, request):
+        # renamed in Django 1.6
+        if hasattr(self, 'queryset'):
+            queryset, root_queryset = self.queryset, self.root_queryset
+        else:
+            queryset, root_queryset = self.query_set, self.root_query_set
+
+        paginator = self.model_admin.get_paginator(request, queryset,
+                                                   self.list_per_page)
+        result_count = paginator.count
+        if not queryset.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = estimated_count(root_queryset)
+
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = queryset._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.show_full_result_count = True
+        self.show_admin_actions = True
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
+class DeliveryAttemptInline(admin.TabularInline):
+    model = DeliveryAttempt
+    fields = ('attempted_on', 'error')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+class StalledRequestAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'project', 'status', 'phone_number',
+                    'originated_on', 'created_on', 'attempts',
+                    'last_attempt_on', 'delivered_on')
+    list_filter = ('status', 'project')
+    list_select_related = ('project',)
+    search_fields = ('phone_number',)
+    paginator = EstimatedCountPaginator
+    inlines = [DeliveryAttemptInline]
+
+    def get_changelist(self, request, **kwargs):
+        return EstimatedCountChangeList
+
+
+class DrainLeaseAdmin(admin.ModelAdmin):
+    list_display = ('project', 'owner', 'expires_on')
 
 admin.site.register(Project)
-admin.site.register(StalledRequest)
+admin.site.register(StalledRequest, StalledRequestAdmin)
+admin.site.register(DrainLease, DrainLeaseAdmin)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" Offline transfer of queued requests between isafonda nodes.
+
+    Files are gzipped JSON lines: a header, one line per chunk of rows
+    with the SHA-256 of its rows, and a footer with the totals.
+    Attachments (blobs) referenced by a chunk's rows precede it, base64
+    encoded over one or more lines; their digest is their checksum. """
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import base64
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+
+from isafonda.blobs import blob_store, CHUNK_SIZE
+from isafonda.models import FondaSMSRequest, Project, StalledRequest
+from isafonda.pending import pending_index
+from isafonda.utils import chunked, make_idempotency_key
+
+FORMAT = 'isafonda-backlog'
+# 2: rows list their blobs, which are included
+VERSION = 2
+VERSIONS = (1, 2)
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+DIRECTIONS = {
+    StalledRequest.PENDING_DOWNSTREAM: (StalledRequest.PENDING_DOWNSTREAM,
+                                        StalledRequest.SENT_DOWNSTREAM),
+    StalledRequest.PENDING_UPSTREAM: (StalledRequest.PENDING_UPSTREAM,
+                                      StalledRequest.SENT_UPSTREAM),
+}
+
+
+logger = logging.getLogger(__name__)
+
+
+class BacklogError(ValueError):
+    pass
+
+
+def checksum(rows):
+    return hashlib.sha256(json.dumps(rows, sort_keys=True)
+                          .encode('utf-8')).hexdigest()
+
+
+def _write(fileobj, obj):
+    fileobj.write((json.dumps(obj) + '\n').encode('utf-8'))
+
+
+def row_from(sreq):
+    key = sreq.idempotency_key
+    if key is None:
+        if sreq.status == StalledRequest.PENDING_DOWNSTREAM:
+            key = FondaSMSRequest(sreq.payload).idempotency_key
+        else:
+            # identical messages may be distinct requests: key the row
+            key = make_idempotency_key('row', sreq.project_id, sreq.id,
+                                       sreq.created_on.strftime(DATE_FORMAT))
+    blobs = []
+    if sreq.status == StalledRequest.PENDING_DOWNSTREAM:
+        blobs = sorted([ref['digest'] for ref
+                        in FondaSMSRequest(sreq.payload).files.values()])
+    return {'status': sreq.status,
+            'originated_on': sreq.originated_on.strftime(DATE_FORMAT),
+            'phone_number': sreq.phone_number,
+            'payload': sreq.payload,
+            'idempotency_key': key,
+            'blobs': blobs}
+
+
+def _write_blob(fileobj, digest):
+    """ blob as lines of base64 pieces. Returns whether it was found """
+    if not blob_store.exists(digest):
+        logger.warning("Blob {} is missing: not exported".format(digest))
+        return False
+    with blob_store.open(digest) as blob:
+        piece = blob.read(CHUNK_SIZE)
+        while True:
+            following = blob.read(CHUNK_SIZE)
+            _write(fileobj, {'blob': digest,
+                             'data': base64.b64encode(piece).decode('ascii'),
+                             'more': bool(following)})
+            if not following:
+                return True
+            piece = following
+
+
+def _blob_pieces(first, lines):
+    line = first
+    while True:
+        yield base64.b64decode(line['data'].encode('ascii'))
+        if not line.get('more'):
+            return
+        line = next(lines, None)
+        if line is None or line.get('blob') != first['blob']:
+            raise BacklogError("Truncated blob {}".format(first['blob']))
+
+
+def _read_blob(first, lines):
+    """ store blob starting at line `first` """
+    digest, size = blob_store.store(_blob_pieces(first, lines))
+    if digest != first['blob']:
+        raise BacklogError("Corrupted blob {}".format(first['blob']))
+
+
+def request_from(project, row):
+    payload = row['payload']
+    if row['status'] == StalledRequest.PENDING_DOWNSTREAM:
+        payload = FondaSMSRequest(payload)
+    return StalledRequest(
+        project=project,
+        status=row['status'],
+        originated_on=datetime.datetime.strptime(row['originated_on'],
+                                                 DATE_FORMAT),
+        phone_number=row['phone_number'],
+        payload=payload,
+        idempotency_key=row['idempotency_key'])
+
+
+def export_backlog(project, path, statuses=None, chunk_size=1000):
+    """ write pending requests of project to path. Returns exported ids """
+    statuses = statuses or list(DIRECTIONS.keys())
+    qs = StalledRequest.objects.filter(project=project,
+                                       status__in=statuses) \
+                               .order_by('created_on', 'id')
+    exported = []
+    nb_chunks = 0
+    blobs = set()
+    with gzip.open(path, 'wb') as fileobj:
+        _write(fileobj, {'format': FORMAT,
+                         'version': VERSION,
+                         'project': project.slug,
+                         'exported_on': datetime.datetime.now()
+                                                .strftime(DATE_FORMAT)})
+        for sreqs in chunked(qs.iterator(), chunk_size):
+            rows = [row_from(sreq) for sreq in sreqs]
+            for row in rows:
+                for digest in row['blobs']:
+                    if digest not in blobs and _write_blob(fileobj, digest):
+                        blobs.add(digest)
+            _write(fileobj, {'chunk': nb_chunks,
+                             'sha256': checksum(rows),
+                             'rows': rows})
+            exported += [sreq.id for sreq in sreqs]
+            nb_chunks += 1
+        _write(fileobj, {'chunks': nb_chunks, 'rows': len(exported),
+                         'blobs': len(blobs)})
+    return exported
+
+
+def read_backlog(path):
+    """ header, then verified lists of rows, chunk by chunk
+
+        Blobs are stored as they are read, before rows using them. """
+    with gzip.open(path, 'rb') as fileobj:
+        lines = (json.loads(line.decode('utf-8')) for line in fileobj)
+        try:
+            header = next(lines)
+        except StopIteration:
+            raise BacklogError("Empty file")
+        if header.get('format') != FORMAT \
+                or header.get('version') not in VERSIONS:
+            raise BacklogError("Not an isafonda backlog file")
+        yield header
+
+        nb_chunks = nb_rows = nb_blobs = 0
+        for line in lines:
+            if 'blob' in line:
+                _read_blob(line, lines)
+                nb_blobs += 1
+                continue
+            if 'rows' in line and 'chunk' not in line:
+                if line['chunks'] != nb_chunks or line['rows'] != nb_rows \
+                        or line.get('blobs', 0) != nb_blobs:
+                    raise BacklogError("Truncated file")
+                return
+            if line.get('chunk') != nb_chunks \
+                    or checksum(line['rows']) != line.get('sha256'):
+                raise BacklogError("Corrupted chunk #{}".format(nb_chunks))
+            nb_chunks += 1
+            nb_rows += len(line['rows'])
+            yield line['rows']
+        raise BacklogError("Truncated file")
+
+
+def import_backlog(path, project=None):
+    """ store requests from path, skipping those already known.
+
+        Chunks are committed as they are read; importing the same file
+        again (after an interruption) only adds what is missing.
+        Returns (project, imported, skipped). """
+    chunks = read_backlog(path)
+    header = next(chunks)
+    if project is None:
+        project = Project.objects.get(slug=header['project'])
+
+    imported = skipped = 0
+    for rows in chunks:
+        known = set()
+        for pending, statuses in DIRECTIONS.items():
+            known |= StalledRequest.known_keys(
+                project,
+                [row['idempotency_key'] for row in rows
+                 if row['status'] == pending],
+                statuses)
+        sreqs = [request_from(project, row) for row in rows
+                 if row['idempotency_key'] not in known]
+        StalledRequest.objects.bulk_create(sreqs)
+        imported += len(sreqs)
+        skipped += len(rows) - len(sreqs)
+
+        for sreq in sreqs:
+            if sreq.status == StalledRequest.PENDING_UPSTREAM:
+                pending_index.mark(pending_index.UPSTREAM, project,
+                                   sreq.phone_number)
+            else:
+                pending_index.mark(pending_index.DOWNSTREAM, project)
+    return project, imported, skipped
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobStore(object):
+    """ Files on disk, named after the SHA-256 of their content.
+
+        Lets queued requests reference large parts (MMS attachments)
+        instead of holding them. """
+
+    @property
+    def root(self):
+        return settings.BLOB_STORE_DIR
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def store(self, chunks):
+        """ write chunks (of bytes) to store. Returns (digest, size) """
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    size += len(chunk)
+                    tmp_file.write(chunk)
+            digest = sha.hexdigest()
+            if self.exists(digest):
+                os.remove(tmp_path)
+                # in use again: not to be purged
+                os.utime(self.path(digest), None)
+            else:
+                if not os.path.isdir(os.path.dirname(self.path(digest))):
+                    os.makedirs(os.path.dirname(self.path(digest)))
+                os.rename(tmp_path, self.path(digest))
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest, size
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+    def digests(self, older_than=0):
+        """ digests of blobs last stored more than older_than seconds ago """
+        since = time.time() - older_than
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if len(filename) == 64 and os.path.getmtime(
+                        os.path.join(dirpath, filename)) < since:
+                    yield filename
+
+    def remove(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except OSError:
+            # removed by another process
+            pass
+
+# Blob Store Initializer
+blob_store = BlobStore()
+
+
+def iter_file(fileobj):
+    while True:
+        chunk = fileobj.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return '{}'.format(value).encode('utf-8')
+
+
+class MultipartStream(object):
+    """ multipart/form-data body read from disk as it is sent.
+
+        `files` maps field names to blob references
+        ({'digest', 'name', 'content_type', 'size'}) or to files
+        ({'file', 'name', 'content_type', 'size'}), e.g. uploads.
+        Has a length so it's sent with a Content-Length. """
+
+    def __init__(self, fields, files, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.parts = []
+        for name, value in fields.items():
+            self.parts.append(
+                self._header(name) + b'\r\n' + _to_bytes(value) + b'\r\n')
+        for name, ref in files.items():
+            self.parts.append(self._header(name, ref) + b'\r\n')
+            self.parts.append(ref)
+            self.parts.append(b'\r\n')
+        self.parts.append(_to_bytes('--{}--\r\n'.format(self.boundary)))
+        self.length = sum([part['size'] if isinstance(part, dict)
+                           else len(part) for part in self.parts])
+        self._chunks = self.iter_chunks()
+        self._buffer = b''
+
+    def _header(self, name, ref=None):
+        header = '--{boundary}\r\nContent-Disposition: form-data; ' \
+                 'name="{name}"'.format(boundary=self.boundary,
+                                        name=name.replace('"', '%22'))
+        if ref is not None:
+            header += '; filename="{name}"\r\nContent-Type: {ctype}'.format(
+                name=(ref['name'] or name).replace('"', '%22'),
+                ctype=ref['content_type'] or 'application/octet-stream')
+        return _to_bytes(header + '\r\n')
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        return self.length
+
+    def iter_chunks(self):
+        for part in self.parts:
+            if not isinstance(part, dict):
+                yield part
+                continue
+            if 'file' in part:
+                part['file'].seek(0)
+                for chunk in iter_file(part['file']):
+                    yield chunk
+                continue
+            with blob_store.open(part['digest']) as blob:
+                for chunk in iter_file(blob):
+                    yield chunk
+
+    def __iter__(self):
+        return self._chunks
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
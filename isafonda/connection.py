@@ -5,27 +5,46 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import datetime
+import threading
+import time
 
+from django.conf import settings
+from django.core.cache import cache
+
+from isafonda.latency import latency
 from isafonda.models import Project
 
 
 class ConnectionStatus(object):
+    """ Last known state of the link to server, per project.
+
+        State is kept in Django's cache so that what web workers learn
+        from traffic is seen by `ping_downstream` (use a shared CACHES
+        backend). Projects are initialized on first use so that creating
+        the holder doesn't touch the DB (import time, before migrations).
+        `warm_up()` optionally probes all projects upfront. """
 
     UNKNWON = 'unknown'
     WORKING = 'working'
     NOT_WORKING = 'not-working'
 
     def __init__(self):
-        self.data = {}
-        self.init_for_all()
+        self.lock = threading.RLock()
+
+    def _key(self, project):
+        return 'isafonda:conn_status:{}'.format(project.slug)
+
+    def _store(self, project, data):
+        cache.set(self._key(project), data, settings.CONNECTION_STATUS_TTL)
 
     def init_for(self, project, with_update=False):
         now = datetime.datetime.now()
-        self.data[project.slug] = {
-            'status': self.UNKNWON,
-            'last_change': now,
-            'last_update': now
-        }
+        with self.lock:
+            self._store(project, {
+                'status': self.UNKNWON,
+                'last_change': now,
+                'last_update': now
+            })
         if with_update:
             self.update_from_network(project)
 
@@ -33,26 +52,60 @@ class ConnectionStatus(object):
         for project in Project.objects.all():
             self.init_for(project)
 
+    def warm_up(self, background=True):
+        """ probe all projects now, in a thread if `background` """
+        if not background:
+            return self.update_all_status(force=True)
+        thread = threading.Thread(target=self.update_all_status,
+                                  kwargs={'force': True})
+        thread.daemon = True
+        thread.start()
+        return thread
+
     def update(self, project, status):
         now = datetime.datetime.now()
-        if status != self.status:
-            self._set(project, 'status', status)
-            self._set(project, 'last_change', now)
-        self._set(project, 'last_update', now)
+        with self.lock:
+            data = self._data(project)
+            if status != data['status']:
+                data.update({'status': status, 'last_change': now})
+            data['last_update'] = now
+            self._store(project, data)
 
     def update_from_network(self, project):
+        """ actively probe the server """
         from isafonda.utils import test_connection
-        nstatus = self.WORKING if test_connection(project.url, project.timeout) \
-                               else self.NOT_WORKING
+        start = time.time()
+        # probes (HEAD/GET) don't tell how long real requests take
+        if test_connection(project.url,
+                           latency.timeout(project, latency.PROBE)):
+            latency.record(project, latency.PROBE, time.time() - start)
+            nstatus = self.WORKING
+        else:
+            nstatus = self.NOT_WORKING
         self.update(project, nstatus)
 
+    def _data(self, project):
+        with self.lock:
+            data = cache.get(self._key(project))
+            if data is None:
+                self.init_for(project)
+                data = cache.get(self._key(project))
+        # cache may not keep it (dummy backend)
+        if data is None:
+            now = datetime.datetime.now()
+            data = {'status': self.UNKNWON,
+                    'last_change': now,
+                    'last_update': now}
+        return data
+
     def _get(self, project, prop):
-        return self.data.get(project.slug, {}).get(prop)
+        return self._data(project).get(prop)
 
     def _set(self, project, prop, value):
-        if not hasattr(self.data, project.slug):
-            self.data.update({project.slug: {}})
-        self.data[project.slug].update({prop: value})
+        with self.lock:
+            data = self._data(project)
+            data.update({prop: value})
+            self._store(project, data)
 
     def status(self, project):
         return self._get(project, 'status')
@@ -69,9 +122,36 @@ class ConnectionStatus(object):
     def is_working(self, project):
         return self.status(project) == self.WORKING
 
-    def update_all_status(self):
-        for project in Project.objects.all():
-            self.update_from_network(project)
+    def needs_probe(self, project):
+        """ whether no real traffic told us about the server lately """
+        last_update = self.last_update(project)
+        if self.status(project) == self.UNKNWON:
+            return True
+        idle = datetime.datetime.now() - last_update
+        return idle.total_seconds() >= settings.PROBE_IDLE_INTERVAL
+
+    def update_all_status(self, deadline=None, force=False):
+        """ probe idle projects concurrently, within `deadline` seconds
+
+            Projects with recent traffic are not probed unless `force`.
+            Probes still running at deadline are left to complete
+            in background. Returns the list of probed projects. """
+        if deadline is None:
+            deadline = settings.PROBE_DEADLINE
+
+        projects = [project for project in Project.objects.all()
+                    if force or self.needs_probe(project)]
+        threads = [threading.Thread(target=self.update_from_network,
+                                    args=(project,))
+                   for project in projects]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        ends_on = time.time() + deadline
+        for thread in threads:
+            thread.join(max(0, ends_on - time.time()))
+        return projects
 
 # Status Holder Initializer
 conn_status = ConnectionStatus()
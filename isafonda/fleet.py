@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class PhoneFleet(object):
+    """ Phones polling a project and messages handed to each.
+
+        Phones that polled in the last PHONE_ACTIVE_WINDOW seconds share
+        the messages without a target phone. With MAX_IN_FLIGHT_PER_PHONE,
+        a phone gets no more messages until it reports (send_status) on
+        those it holds. Counters expire after IN_FLIGHT_TTL seconds
+        so that lost reports don't block a phone forever. """
+
+    # send_status values closing a message
+    FINAL_STATUSES = ('sent', 'failed', 'cancelled')
+
+    def _key(self, kind, project, phone_number=None):
+        return 'isafonda:fleet:{kind}:{project}:{phone}'.format(
+            kind=kind, project=project.slug, phone=phone_number or '')
+
+    def _active(self, project):
+        now = time.time()
+        phones = cache.get(self._key('phones', project)) or {}
+        return dict([(phone, seen_on) for phone, seen_on in phones.items()
+                     if now - seen_on < settings.PHONE_ACTIVE_WINDOW])
+
+    def seen(self, project, phone_number):
+        """ phone polled. Recorded at most twice per window """
+        phones = self._active(project)
+        seen_on = phones.get(phone_number)
+        now = time.time()
+        if seen_on is not None \
+                and now - seen_on < settings.PHONE_ACTIVE_WINDOW / 2:
+            return
+        phones[phone_number] = now
+        cache.set(self._key('phones', project), phones,
+                  settings.PHONE_ACTIVE_WINDOW)
+
+    def nb_active(self, project):
+        return max(1, len(self._active(project)))
+
+    def in_flight(self, project, phone_number):
+        return cache.get(self._key('inflight', project, phone_number)) or 0
+
+    def room(self, project, phone_number):
+        """ messages phone can still receive (None if unlimited) """
+        if settings.MAX_IN_FLIGHT_PER_PHONE is None:
+            return None
+        return max(0, settings.MAX_IN_FLIGHT_PER_PHONE
+                   - self.in_flight(project, phone_number))
+
+    def handed(self, project, phone_number, nb_messages):
+        if settings.MAX_IN_FLIGHT_PER_PHONE is None or not nb_messages:
+            return
+        key = self._key('inflight', project, phone_number)
+        try:
+            cache.incr(key, nb_messages)
+        except ValueError:
+            cache.set(key, nb_messages, settings.IN_FLIGHT_TTL)
+
+    def acknowledge(self, project, phone_number, status):
+        """ phone reported on a message """
+        if settings.MAX_IN_FLIGHT_PER_PHONE is None \
+                or status not in self.FINAL_STATUSES:
+            return
+        key = self._key('inflight', project, phone_number)
+        try:
+            if cache.decr(key) < 0:
+                cache.set(key, 0, settings.IN_FLIGHT_TTL)
+        except ValueError:
+            pass
+
+# Fleet Holder Initializer
+fleet = PhoneFleet()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import math
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from requests.exceptions import Timeout, ConnectionError
+
+
+def percentile(values, pct):
+    """ nearest-rank percentile of an unsorted list """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100 * len(ordered)))
+    return ordered[max(0, min(rank, len(ordered)) - 1)]
+
+
+def is_read_timeout(exp):
+    """ server accepted the connection but answered too late """
+    return isinstance(exp, Timeout) and not isinstance(exp, ConnectionError)
+
+
+class LatencyTracker(object):
+    """ Round-trip times to server, per project and per path.
+
+        Samples are kept in Django's cache so that web workers and
+        `ping_downstream` runs share them (use a shared CACHES backend).
+        A call that timed out is recorded with its timeout, a lower bound
+        of its actual duration, so that slow replies raise the estimate.
+
+        Timeouts are derived from the observed percentile once enough
+        samples have been collected. Until then, `Project.timeout` is used.
+        Retries of a same request get escalating timeouts, never below
+        `Project.timeout`. """
+
+    # phone polls
+    LIVE = 'live'
+    # replay of stalled requests
+    DRAIN = 'drain'
+    # health probes (may be cheaper than real requests)
+    PROBE = 'probe'
+
+    PATHS = (LIVE, DRAIN, PROBE)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def _key(self, project, path):
+        return 'isafonda:latency:{project}:{path}'.format(
+            project=project.slug, path=path)
+
+    def record(self, project, path, seconds):
+        with self.lock:
+            key = self._key(project, path)
+            samples = cache.get(key) or []
+            samples.append(seconds)
+            cache.set(key, samples[-settings.ADAPTIVE_TIMEOUT_SAMPLES:],
+                      settings.ADAPTIVE_TIMEOUT_SAMPLES_TTL)
+
+    def record_response(self, project, path, response):
+        self.record(project, path, response.elapsed.total_seconds())
+
+    def record_failure(self, project, path, exp, timeout):
+        """ censored sample: took at least `timeout` """
+        if is_read_timeout(exp):
+            self.record(project, path, timeout)
+
+    def samples(self, project, path):
+        return list(cache.get(self._key(project, path)) or [])
+
+    def percentile(self, project, path, pct):
+        return percentile(self.samples(project, path), pct)
+
+    def timeout(self, project, path, attempts=0):
+        """ timeout for a call, `attempts` being its previous failures """
+        value = project.timeout
+        if settings.ADAPTIVE_TIMEOUT:
+            samples = self.samples(project, path)
+            if len(samples) >= settings.ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+                value = percentile(samples,
+                                   settings.ADAPTIVE_TIMEOUT_PERCENTILE) \
+                    * settings.ADAPTIVE_TIMEOUT_FACTOR
+                value = min(max(value, settings.ADAPTIVE_TIMEOUT_FLOOR),
+                            settings.ADAPTIVE_TIMEOUT_CEILING)
+
+        if attempts > 0:
+            value = max(value, project.timeout) \
+                * settings.ADAPTIVE_TIMEOUT_ESCALATION ** attempts
+            value = min(value, max(settings.ADAPTIVE_TIMEOUT_CEILING,
+                                   project.timeout))
+        return value
+
+    def stats(self, project):
+        stats = {}
+        for path in self.PATHS:
+            samples = self.samples(project, path)
+            stats[path] = {
+                'samples': len(samples),
+                'p50': percentile(samples, 50),
+                'p99': percentile(samples, 99),
+                'timeout': self.timeout(project, path)}
+        return stats
+
+    def describe(self, project, path):
+        stats = self.stats(project)[path]
+        if not stats['samples']:
+            return "{path} timeout {timeout:.1f}s (no samples)".format(
+                path=path, **stats)
+        return ("{path} timeout {timeout:.1f}s (p50 {p50:.2f}s, "
+                "p99 {p99:.2f}s, {samples} samples)").format(path=path,
+                                                            **stats)
+
+# Latency Holder Initializer
+latency = LatencyTracker()
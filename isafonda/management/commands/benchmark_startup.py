@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import os
+import subprocess
+import sys
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from isafonda.models import Project
+from isafonda.connection import ConnectionStatus
+from isafonda.utils import atomic
+
+# run in a fresh interpreter: prints seconds spent on `statement`
+TIMED_SCRIPT = """
+import time
+start = time.time()
+{statement}
+print(time.time() - start)
+"""
+
+IMPORT_STATEMENT = """
+import django
+if hasattr(django, 'setup'):
+    django.setup()
+import isafonda.views
+"""
+
+BOOT_STATEMENT = """
+from isafonda.wsgi import application
+"""
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Time module import, worker boot and ConnectionStatus startup"
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--projects',
+                    action="store",
+                    type="int",
+                    dest='projects',
+                    default=1000,
+                    help='Number of temporary projects to create'),
+        make_option('-r', '--rounds',
+                    action="store",
+                    type="int",
+                    dest='rounds',
+                    default=10,
+                    help='Number of measures to average'),)
+
+    PREFIX = 'benchmark-'
+
+    def handle(self, *args, **options):
+        nb_projects = options.get('projects')
+        rounds = max(1, options.get('rounds'))
+
+        imports = self.measure_process(IMPORT_STATEMENT, rounds)
+        boot = self.measure_process(BOOT_STATEMENT, rounds)
+
+        # temporary projects are never committed
+        try:
+            with atomic():
+                eager, lazy, first_use = self.measure_status(nb_projects,
+                                                             rounds)
+                raise Rollback()
+        except Rollback:
+            pass
+
+        print("module import:\t{:.3f}ms".format(imports * 1000))
+        print("worker boot:\t{:.3f}ms".format(boot * 1000))
+        print("eager startup:\t{:.3f}ms".format(eager * 1000))
+        print("lazy startup:\t{:.3f}ms".format(lazy * 1000))
+        print("lazy first use:\t{:.3f}ms".format(first_use * 1000))
+
+    def measure_status(self, nb_projects, rounds):
+        print("Creating {} temporary projects.".format(nb_projects))
+        projects = [Project(slug='{}{}'.format(self.PREFIX, index),
+                            name="Benchmark #{}".format(index),
+                            url='http://localhost/')
+                    for index in range(nb_projects)]
+        Project.objects.bulk_create(projects)
+
+        try:
+            eager = self.measure(self.eager_startup, rounds)
+            lazy = self.measure(ConnectionStatus, rounds)
+            first_use = self.measure(
+                lambda: ConnectionStatus().status(projects[0]), rounds)
+        finally:
+            # statuses of temporary projects
+            cache.delete_many([ConnectionStatus()._key(project)
+                               for project in projects])
+        return eager, lazy, first_use
+
+    def eager_startup(self):
+        # what the holder used to do at import time
+        conn_status = ConnectionStatus()
+        conn_status.init_for_all()
+        return conn_status
+
+    def measure(self, func, rounds):
+        start = time.time()
+        for _ in range(rounds):
+            func()
+        return (time.time() - start) / rounds
+
+    def measure_process(self, statement, rounds):
+        """ average time of `statement` in fresh interpreters """
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'isafonda.settings')
+        script = TIMED_SCRIPT.format(statement=statement.strip())
+        total = 0
+        for _ in range(rounds):
+            output = subprocess.check_output([sys.executable, '-c', script],
+                                             env=env)
+            total += float(output.decode('utf-8').strip().splitlines()[-1])
+        return total / rounds
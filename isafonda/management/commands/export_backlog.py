@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from isafonda.backlog import export_backlog, DIRECTIONS
+from isafonda.models import Project, StalledRequest
+
+
+class Command(BaseCommand):
+    help = "Export pending requests of a project to a file (sneakernet)"
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--project',
+                    action="store",
+                    dest='project',
+                    default=None,
+                    help='Project slug to export'),
+        make_option('-o', '--output',
+                    action="store",
+                    dest='output',
+                    default=None,
+                    help='Path of the file to create (.jsonl.gz)'),
+        make_option('-s', '--status',
+                    action="append",
+                    dest='statuses',
+                    default=None,
+                    choices=list(DIRECTIONS.keys()),
+                    help='Only export this status (repeatable)'),
+        make_option('-c', '--chunk-size',
+                    action="store",
+                    type="int",
+                    dest='chunk_size',
+                    default=1000,
+                    help='Number of requests per checksummed chunk'),
+        make_option('--move',
+                    action="store_true",
+                    dest='move',
+                    default=False,
+                    help='Remove exported requests once file is written'),)
+
+    def handle(self, *args, **options):
+        project_slug = options.get('project')
+        try:
+            project = Project.objects.get(slug=project_slug)
+        except Project.DoesNotExist:
+            print("Unable to find poject with slug `{}`".format(project_slug))
+            return
+
+        output = options.get('output') \
+            or '{}-backlog.jsonl.gz'.format(project.slug)
+
+        print("Exporting pending requests for `{}` to {}"
+              .format(project.slug, output))
+
+        exported = export_backlog(project, output,
+                                  statuses=options.get('statuses'),
+                                  chunk_size=options.get('chunk_size'))
+
+        print("{} requests exported.".format(len(exported)))
+
+        if options.get('move'):
+            for ids in [exported[i:i + 500]
+                        for i in range(0, len(exported), 500)]:
+                StalledRequest.objects.filter(id__in=ids).delete()
+            print("Exported requests removed.")
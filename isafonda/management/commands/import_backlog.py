@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from isafonda.backlog import import_backlog, BacklogError
+from isafonda.models import Project
+
+
+class Command(BaseCommand):
+    help = "Import pending requests exported by export_backlog"
+    option_list = BaseCommand.option_list + (
+        make_option('-i', '--input',
+                    action="store",
+                    dest='input',
+                    default=None,
+                    help='Path of the file to import'),
+        make_option('-p', '--project',
+                    action="store",
+                    dest='project',
+                    default=None,
+                    help='Project slug to import into (default: exported one)'),)
+
+    def handle(self, *args, **options):
+        project = None
+        project_slug = options.get('project')
+        if project_slug is not None:
+            try:
+                project = Project.objects.get(slug=project_slug)
+            except Project.DoesNotExist:
+                print("Unable to find poject with slug `{}`"
+                      .format(project_slug))
+                return
+
+        print("Importing requests from {}".format(options.get('input')))
+
+        try:
+            project, imported, skipped = import_backlog(
+                options.get('input'), project=project)
+        except (BacklogError, Project.DoesNotExist) as exp:
+            raise CommandError("Import failed: {}".format(exp))
+
+        print("{} requests imported into `{}`, {} already known."
+              .format(imported, project.slug, skipped))
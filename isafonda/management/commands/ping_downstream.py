@@ -8,8 +8,9 @@ from __future__ import (unicode_literals, absolute_import,
 from django.core.management.base import BaseCommand
 from optparse import make_option
 
-from isafonda.models import Project, StalledRequest
-from isafonda.utils import test_connection
+from isafonda.models import Project, DrainLease
+from isafonda.replay import replay_downstream
+from isafonda.latency import latency
 from isafonda.connection import conn_status
 
 
@@ -20,10 +21,19 @@ class Command(BaseCommand):
                     action="store",
                     dest='project',
                     default=None,
-                    help='Project slug to check unpon'),)
+                    help='Project slug to check unpon (all projects if omitted)'),
+        make_option('-w', '--workers',
+                    action="store",
+                    type="int",
+                    dest='workers',
+                    default=None,
+                    help='Number of phones/senders replayed in parallel'),)
 
     def handle(self, *args, **options):
         project_slug = options.get('project')
+        if project_slug is None:
+            return self.handle_all(**options)
+
         try:
             project = Project.objects.get(slug=project_slug)
         except Project.DoesNotExist:
@@ -32,25 +42,55 @@ class Command(BaseCommand):
 
         print("Pinging server for project `{}`".format(project.slug))
 
+        # status is shared with web workers: working means live traffic
+        # reached server lately, pending requests still have to be sent.
         if conn_status.is_working(project):
-            print("Last known state was working. Exiting.")
+            print("Last known state was working. Processing.")
+            self.drain(project, options.get('workers'))
             return
 
         print("Testing connection now.")
 
-        if not test_connection(project.url, project.timeout):
-            conn_status.update(project, conn_status.NOT_WORKING)
+        conn_status.update_from_network(project)
+        if not conn_status.is_working(project):
             print("Connection not working. Exiting.")
             return
 
-        # record that it worked
-        conn_status.update(project, conn_status.WORKING)
         print("Connection is now working. Processing.")
+        self.drain(project, options.get('workers'))
+
+    def handle_all(self, **options):
+        print("Pinging server for all projects.")
+
+        conn_status.update_all_status()
+
+        for project in Project.objects.all():
+            if not conn_status.is_working(project):
+                print("`{}`: connection not working.".format(project.slug))
+                continue
+            print("`{}`: connection working. Processing."
+                  .format(project.slug))
+            self.drain(project, options.get('workers'))
+
+    def drain(self, project, workers):
+        # another node sharing the DB may be in charge of this project
+        if not DrainLease.acquire(project):
+            print("`{}` is drained by another node. Skipping."
+                  .format(project.slug))
+            return
 
         # clear-up the pending requests for server
-        for sreq in StalledRequest.objects.filter(
-                project=project,
-                status=StalledRequest.PENDING_DOWNSTREAM):
-            sreq.retry_downstream()
+        try:
+            stats = replay_downstream(
+                project, workers=workers,
+                renew=lambda: DrainLease.renew(project))
+        finally:
+            # next run (or its preferred node) takes it over
+            DrainLease.release(project)
 
-        print("Updates completed.")
+        if stats['interrupted']:
+            print("Lease on `{}` was lost. Stopped.".format(project.slug))
+        print("Updates completed: {sent} sent, {failed} failed, "
+              "{skipped} postponed ({partitions} phones)."
+              .format(**stats))
+        print(latency.describe(project, latency.DRAIN))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import pstats
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from isafonda.profiling import profile_files
+
+
+class Command(BaseCommand):
+    help = "Summarize hot functions across collected profiles"
+    option_list = BaseCommand.option_list + (
+        make_option('-p', '--project',
+                    action="store",
+                    dest='project',
+                    default=None,
+                    help='Only profiles of this project slug'),
+        make_option('-n', '--limit',
+                    action="store",
+                    type="int",
+                    dest='limit',
+                    default=25,
+                    help='Number of functions to list'),
+        make_option('-s', '--sort',
+                    action="store",
+                    dest='sort',
+                    default='cumulative',
+                    help='pstats sort key (cumulative, tottime, calls...)'),)
+
+    def handle(self, *args, **options):
+        files = profile_files(options.get('project'))
+        if not files:
+            print("No profile collected.")
+            return
+
+        print("Summary of {} profiles.".format(len(files)))
+
+        stats = pstats.Stats(files[0])
+        for path in files[1:]:
+            stats.add(path)
+        stats.strip_dirs().sort_stats(options.get('sort')) \
+             .print_stats(options.get('limit'))
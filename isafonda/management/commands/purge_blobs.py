@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from isafonda.blobs import blob_store
+from isafonda.models import FondaSMSRequest, StalledRequest
+
+
+class Command(BaseCommand):
+    help = "Remove attachments no pending request refers to"
+    option_list = BaseCommand.option_list + (
+        make_option('-a', '--age',
+                    action="store",
+                    type="int",
+                    dest='age',
+                    default=3600,
+                    help='Keep blobs stored less than this (seconds) ago'),
+        make_option('-n', '--dry-run',
+                    action="store_true",
+                    dest='dry_run',
+                    default=False,
+                    help='Only list blobs that would be removed'),)
+
+    def handle(self, *args, **options):
+        # listed first: blobs stored meanwhile are recent, thus kept
+        candidates = set(blob_store.digests(older_than=options.get('age')))
+
+        # only requests still to be sent to server need their attachments
+        qs = StalledRequest.objects.filter(
+            status=StalledRequest.PENDING_DOWNSTREAM).only('id', 'payload')
+        for sreq in qs.iterator():
+            for ref in FondaSMSRequest(sreq.payload).files.values():
+                candidates.discard(ref.get('digest'))
+
+        for digest in sorted(candidates):
+            print(digest)
+            if not options.get('dry_run'):
+                blob_store.remove(digest)
+
+        print("{} blobs {}.".format(
+            len(candidates),
+            "to remove" if options.get('dry_run') else "removed"))
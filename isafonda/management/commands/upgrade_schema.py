@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+
+from isafonda.models import StalledRequest
+from isafonda.utils import atomic
+
+# (model, field name) added to existing tables, oldest first.
+# syncdb only creates missing tables.
+ADDED_FIELDS = (
+    (StalledRequest, 'idempotency_key'),
+    # delivery lifecycle
+    (StalledRequest, 'attempts'),
+    (StalledRequest, 'first_attempt_on'),
+    (StalledRequest, 'last_attempt_on'),
+    (StalledRequest, 'delivered_on'),
+)
+
+
+def sql_literal(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise CommandError("Unsupported default: {!r}".format(value))
+    return '{}'.format(value)
+
+
+def column_sql(model, field):
+    """ statements adding field's column (and index) to model's table """
+    quote = connection.ops.quote_name
+    table = model._meta.db_table
+    column = '{name} {type} {null}'.format(
+        name=quote(field.column),
+        type=field.db_type(connection=connection),
+        null='NULL' if field.null else 'NOT NULL')
+    if field.has_default():
+        column += ' DEFAULT {}'.format(sql_literal(field.get_default()))
+    statements = ['ALTER TABLE {table} ADD COLUMN {column}'.format(
+        table=quote(table), column=column)]
+    if field.db_index:
+        statements.append('CREATE INDEX {name} ON {table} ({column})'.format(
+            name=quote('{}_{}'.format(table, field.column)),
+            table=quote(table), column=quote(field.column)))
+    return statements
+
+
+def missing_fields():
+    cursor = connection.cursor()
+    columns = {}
+    missing = []
+    for model, name in ADDED_FIELDS:
+        table = model._meta.db_table
+        if table not in columns:
+            columns[table] = [
+                row[0] for row in connection.introspection
+                .get_table_description(cursor, table)]
+        field = model._meta.get_field(name)
+        if field.column not in columns[table]:
+            missing.append((model, field))
+    return missing
+
+
+class Command(BaseCommand):
+    help = "Add columns introduced since tables were created (syncdb)"
+    option_list = BaseCommand.option_list + (
+        make_option('--sql',
+                    action="store_true",
+                    dest='sql',
+                    default=False,
+                    help='Only print the SQL statements'),)
+
+    def handle(self, *args, **options):
+        statements = []
+        for model, field in missing_fields():
+            statements += column_sql(model, field)
+
+        if not statements:
+            print("Schema is up to date.")
+            return
+
+        if options.get('sql'):
+            for statement in statements:
+                print("{};".format(statement))
+            return
+
+        with atomic():
+            cursor = connection.cursor()
+            for statement in statements:
+                print(statement)
+                cursor.execute(statement)
+        print("{} statements applied.".format(len(statements)))
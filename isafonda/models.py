@@ -5,16 +5,31 @@
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import datetime
+import hashlib
 import json
+import logging
+import math
+import os
 
 import requests
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from picklefield.fields import PickledObjectField
 from requests.exceptions import RequestException
 
 from isafonda._compat import implements_to_string
-from isafonda.utils import datetime_from_timestamp
+from isafonda.blobs import blob_store, MultipartStream
+from isafonda.fleet import fleet
+from isafonda.latency import latency
+from isafonda.pending import pending_index
+from isafonda.utils import (datetime_from_timestamp, make_idempotency_key,
+                            idempotency_header)
+
+logger = logging.getLogger(__name__)
 
 
 class FondaSMSRequest(dict):
@@ -34,13 +49,80 @@ class FondaSMSRequest(dict):
     MMS = 'mms'
     CALL = 'call'
 
+    # attached files (MMS parts), as references to the blob store
+    FILES = '_files'
+
+    # files uploaded with the request, until spilled to the blob store
+    uploads = None
+
+    # fields identifying an event (not the state of the phone)
+    IDENTITY_FIELDS = ('action', 'phone_number', 'phone_id', 'from', 'to',
+                       'message_type', 'message', 'mms_parts', 'timestamp',
+                       'id', 'status', 'error')
+
     @classmethod
-    def from_post(cls, post_data):
+    def from_post(cls, post_data, files_data=None):
         d = FondaSMSRequest()
         for k, v in post_data.items():
             d.update({k: v})
+
+        # attachments are only spilled to disk if request is queued
+        if files_data:
+            d.uploads = dict(files_data.items())
         return d
 
+    def spill(self):
+        """ store uploaded files in blob store, reference them instead """
+        if not self.uploads:
+            return
+        files = dict(self.get(self.FILES) or {})
+        for name, uploaded in self.uploads.items():
+            digest, size = blob_store.store(uploaded.chunks())
+            files[name] = {'digest': digest,
+                           'name': uploaded.name,
+                           'content_type': uploaded.content_type,
+                           'size': size}
+        self.update({self.FILES: files})
+        # not to be pickled with payload
+        del self.uploads
+
+    @property
+    def files(self):
+        """ attachments: blob references, or uploads not spilled yet """
+        files = dict(self.get(self.FILES) or {})
+        for name, uploaded in (self.uploads or {}).items():
+            files[name] = {'file': uploaded,
+                           'name': uploaded.name,
+                           'content_type': uploaded.content_type,
+                           'size': uploaded.size}
+        return files
+
+    @property
+    def missing_files(self):
+        """ names of attachments no longer in blob store """
+        return [name for name, ref in self.files.items()
+                if 'digest' in ref and not blob_store.exists(ref['digest'])]
+
+    def without_files(self, names):
+        fondareq = FondaSMSRequest(self)
+        files = dict([(name, ref) for name, ref in self.files.items()
+                      if name not in names])
+        fondareq.pop(self.FILES, None)
+        if files:
+            fondareq.update({self.FILES: files})
+        return fondareq
+
+    @property
+    def form_data(self):
+        return dict([(k, v) for k, v in self.items() if k != self.FILES])
+
+    def encoded(self):
+        """ (body, headers) to post it; attachments streamed from disk """
+        if not self.files:
+            return self.form_data, {}
+        body = MultipartStream(self.form_data, self.files)
+        return body, {'Content-Type': body.content_type}
+
     @property
     def is_mobile(self):
         return self.get('network', self.WIFI) == self.MOBILE
@@ -66,6 +148,17 @@ class FondaSMSRequest(dict):
     def identity(self):
         return self.get('from')
 
+    @property
+    def idempotency_key(self):
+        """ same for every copy (retries) of a same event """
+        parts = [(field, self.get(field))
+                 for field in self.IDENTITY_FIELDS]
+        # polls and device status have no event timestamp nor id:
+        # only the time of request tells them apart.
+        if self.get('timestamp') is None and self.get('id') is None:
+            parts.append(('now', self.get('now')))
+        return make_idempotency_key(*parts)
+
     @property
     def is_test(self):
         return self.get('action') == self.TEST
@@ -146,6 +239,26 @@ class Project(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def cache_key(cls, slug):
+        return 'isafonda:project:{}'.format(slug)
+
+    @classmethod
+    def get_cached(cls, slug):
+        """ Project from cache, or DB. Raises Project.DoesNotExist """
+        project = cache.get(cls.cache_key(slug))
+        if project is None:
+            project = cls.objects.get(slug=slug)
+            cache.set(cls.cache_key(slug), project,
+                      settings.PROJECT_CACHE_TTL)
+        return project
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def clear_project_cache(sender, instance, **kwargs):
+    cache.delete(Project.cache_key(instance.slug))
+
 
 @implements_to_string
 class StalledRequest(models.Model):
@@ -175,56 +288,215 @@ class StalledRequest(models.Model):
     altered_on = models.DateTimeField(auto_now=True)
     phone_number = models.CharField(max_length=50, null=True, blank=True)
     payload = PickledObjectField(null=True, blank=True)
+    idempotency_key = models.CharField(max_length=40, null=True, blank=True,
+                                       db_index=True)
+    # lifecycle: enqueued on `created_on`, then
+    attempts = models.PositiveIntegerField(default=0)
+    first_attempt_on = models.DateTimeField(null=True, blank=True)
+    last_attempt_on = models.DateTimeField(null=True, blank=True)
+    delivered_on = models.DateTimeField(null=True, blank=True,
+                                        db_index=True)
 
     def __str__(self):
-        return "{project}#{id}".format(project=self.project.slug,
+        return "{project}#{id}".format(project=self.project_id,
                                        id=self.id)
 
     @classmethod
-    def from_upstream(cls, project, request):
-        fondareq = FondaSMSRequest.from_post(request.POST)
-        return cls.objects.create(project=project,
+    def find_duplicate(cls, project, idempotency_key, statuses):
+        """ recent request with that key and one of statuses, if any """
+        since = datetime.datetime.now() - datetime.timedelta(
+            seconds=settings.IDEMPOTENCY_WINDOW)
+        duplicates = list(cls.objects.filter(
+            project=project,
+            idempotency_key=idempotency_key,
+            status__in=statuses,
+            created_on__gte=since)[:1])
+        return duplicates[0] if duplicates else None
+
+    @classmethod
+    def known_keys(cls, project, idempotency_keys, statuses):
+        """ those of idempotency_keys recently seen with one of statuses """
+        since = datetime.datetime.now() - datetime.timedelta(
+            seconds=settings.IDEMPOTENCY_WINDOW)
+        return set(cls.objects.filter(
+            project=project,
+            idempotency_key__in=list(idempotency_keys),
+            status__in=statuses,
+            created_on__gte=since).values_list('idempotency_key', flat=True))
+
+    @classmethod
+    def from_upstream(cls, project, request, fondareq=None):
+        if fondareq is None:
+            fondareq = FondaSMSRequest.from_post(request.POST, request.FILES)
+        key = fondareq.idempotency_key
+
+        # phone re-sent an event we already hold
+        duplicate = cls.find_duplicate(project, key, (cls.PENDING_DOWNSTREAM,
+                                                      cls.SENT_DOWNSTREAM))
+        if duplicate is not None:
+            return duplicate
+
+        fondareq.spill()
+        sreq = cls.objects.create(project=project,
                                   status=cls.PENDING_DOWNSTREAM,
                                   originated_on=fondareq.event_date or fondareq.date,
                                   phone_number=fondareq.phone_number or None,
-                                  payload=fondareq)
+                                  payload=fondareq,
+                                  idempotency_key=key)
+        pending_index.mark(pending_index.DOWNSTREAM, project)
+        return sreq
 
     @classmethod
     def get_pending_upstream(cls, project, max_items=None, phone_number=None):
-        max_items = project.max_items if max_items is None else max_items
-        going_items = []
-        remaining = max_items - len(going_items)
-        base_filter = cls.objects.filter(status=cls.PENDING_UPSTREAM)
-        none_list = list(base_filter.filter(phone_number__isnull=True))
+        """ messages for the polling phone, oldest first
 
-        if project.reply_same_phone:
-            all_reqs = list(set(none_list + list(base_filter.filter(phone_number=phone_number))))
-        else:
-            all_reqs = none_list
+            Messages without target phone are shared among active phones:
+            each poll gets at most its share of `max_items` of those. """
+        max_items = project.max_items if max_items is None else max_items
+        share = max_items
+        if phone_number is not None:
+            fleet.seen(project, phone_number)
+            room = fleet.room(project, phone_number)
+            if room is not None:
+                max_items = min(max_items, room)
+            share = int(math.ceil(max_items / fleet.nb_active(project)))
+
+        # most polls have nothing waiting: don't hit the DB
+        if max_items <= 0 \
+                or not pending_index.has_pending_upstream(project,
+                                                          phone_number):
+            return []
+
+        base_filter = cls.objects.filter(project=project,
+                                         status=cls.PENDING_UPSTREAM) \
+                                 .order_by('created_on', 'id')
+        all_reqs = list(base_filter.filter(phone_number__isnull=True)[:share])
+        if project.reply_same_phone and phone_number is not None:
+            all_reqs = sorted(
+                all_reqs + list(base_filter.filter(
+                    phone_number=phone_number)[:max_items]),
+                key=lambda req: (req.created_on, req.id))
 
+        going_items = []
+        nb_shared = 0
         for req in all_reqs:
+            remaining = max_items - len(going_items)
+            if req.phone_number is None:
+                remaining = min(remaining, share - nb_shared)
+            if remaining <= 0:
+                continue
+
+            items = req.payload[:remaining]
             if len(req.payload) <= remaining:
-                going_items += req.payload
-                req.status = cls.SENT_UPSTREAM
+                taken = req.claim()
             else:
-                going_items += req.payload[:remaining]
-                req.payload = req.payload[remaining:]
-            req.save()
+                taken = req.claim(req.payload[remaining:])
+            if not taken:
+                continue
+
+            going_items += items
+            if req.phone_number is None:
+                nb_shared += len(items)
+
+        if phone_number is not None:
+            fleet.handed(project, phone_number, len(going_items))
+
+        pending_index.refresh(pending_index.UPSTREAM, project)
+        if project.reply_same_phone and phone_number is not None:
+            pending_index.refresh(pending_index.UPSTREAM, project,
+                                  phone_number)
         return going_items
 
+    @classmethod
+    def get_pending_push(cls, project, phone_number=None):
+        """ claim messages for phone_number only (or without target if
+            None), oldest first, up to `project.max_items`
+
+            Returns (request, messages taken from it) pairs, so that
+            they can be put back with `unclaim()`. """
+        max_items = project.max_items
+        if phone_number is not None:
+            room = fleet.room(project, phone_number)
+            if room is not None:
+                max_items = min(max_items, room)
+
+        if max_items <= 0 or not pending_index.has_pending_upstream(
+                project, phone_number, shared=phone_number is None):
+            return []
+
+        reqs = cls.objects.filter(project=project,
+                                  status=cls.PENDING_UPSTREAM) \
+                          .order_by('created_on', 'id')
+        if phone_number is None:
+            reqs = reqs.filter(phone_number__isnull=True)
+        else:
+            reqs = reqs.filter(phone_number=phone_number)
+
+        claimed = []
+        nb_items = 0
+        for req in reqs[:max_items]:
+            remaining = max_items - nb_items
+            if remaining <= 0:
+                break
+            items = req.payload[:remaining]
+            if len(req.payload) <= remaining:
+                taken = req.claim()
+            else:
+                taken = req.claim(req.payload[remaining:])
+            if taken:
+                claimed.append((req, items))
+                nb_items += len(items)
+
+        pending_index.refresh(pending_index.UPSTREAM, project, phone_number)
+        return claimed
+
     def retry_downstream(self):
+        """ send to server. Returns whether it was delivered,
+            None if another process is sending it """
+        from isafonda.connection import conn_status
         now = datetime.datetime.now()
+
+        # a copy of this event already reached the server
+        if self.idempotency_key and self.find_duplicate(
+                self.project, self.idempotency_key, (self.SENT_DOWNSTREAM,)):
+            self.update(self.SENT_DOWNSTREAM)
+            return True
+
+        timeout = latency.timeout(self.project, latency.DRAIN,
+                                  attempts=self.attempts)
+        if not self.claim_downstream():
+            return None
+        # older requests were stored as plain dicts
+        fondareq = FondaSMSRequest(self.payload)
+        # a lost attachment is not a server failure: send the rest
+        missing = fondareq.missing_files
+        if missing:
+            logger.warning("Request {sreq}: attachments {names} missing "
+                           "from blob store, sent without them."
+                           .format(sreq=self, names=", ".join(missing)))
+            fondareq = self.payload = fondareq.without_files(missing)
+        data, headers = fondareq.encoded()
+        if self.idempotency_key:
+            headers.update(idempotency_header(self.idempotency_key))
         try:
             req = requests.post(self.project.url,
-                                data=self.payload,
-                                timeout=self.project.timeout)
+                                data=data,
+                                headers=headers,
+                                timeout=timeout)
             req.raise_for_status()
-        except RequestException:
+        except RequestException as exp:
             # failed again. Just update time
+            latency.record_failure(self.project, latency.DRAIN, exp, timeout)
+            conn_status.update(self.project, conn_status.NOT_WORKING)
+            self.log_attempt(self.last_attempt_on, exp)
             self.altered_on = now
             self.save()
+            return False
 
         # worked! store response and change status
+        self.log_attempt(self.last_attempt_on)
+        conn_status.update(self.project, conn_status.WORKING)
+        latency.record_response(self.project, latency.DRAIN, req)
         self.update(self.SENT_DOWNSTREAM)
 
         try:
@@ -232,27 +504,275 @@ class StalledRequest(models.Model):
             events = response_obj['events'][0]['messages']
             phone_number = response_obj.get('phone_number') or None
         except:
-            return
+            return True
 
         # don't store anything if there's no reply
         if not len(events):
-            return
-
-        # we do have some replies to forward upstream
-        self.from_downstream(self.project, events, phone_number)
+            return True
+
+        # we do have some replies to forward upstream.
+        # a retry of this request gets the same replies: same key.
+        from isafonda.push import push_pending
+        reply_key = make_idempotency_key(self.idempotency_key, 'reply') \
+            if self.idempotency_key else None
+        self.from_downstream(self.project, events, phone_number,
+                             idempotency_key=reply_key)
+        push_pending(self.project, phone_number)
+        return True
 
     @classmethod
-    def from_downstream(cls, project, events, phone_number=None):
-        return cls.objects.create(
+    def from_downstream(cls, project, events, phone_number=None,
+                        idempotency_key=None):
+        """ store events for phones
+
+            Only deduplicated with an `idempotency_key`: identical
+            messages (reminders, same reply) are legitimate. """
+        # server re-sent events we already hold
+        if idempotency_key is not None:
+            duplicate = cls.find_duplicate(project, idempotency_key,
+                                           (cls.PENDING_UPSTREAM,
+                                            cls.SENT_UPSTREAM))
+            if duplicate is not None:
+                return duplicate
+
+        sreq = cls.objects.create(
             project=project,
             status=cls.PENDING_UPSTREAM,
             originated_on=datetime.datetime.now(),
             phone_number=phone_number or None,
-            payload=events)
+            payload=events,
+            idempotency_key=idempotency_key)
+        pending_index.mark(pending_index.UPSTREAM, project,
+                           phone_number or None)
+        return sreq
+
 
+    @classmethod
+    def bulk_from_downstream(cls, project, batches):
+        """ store (phone_number, events, idempotency_key) batches at once """
+        now = datetime.datetime.now()
+        cls.objects.bulk_create([
+            cls(project=project,
+                status=cls.PENDING_UPSTREAM,
+                originated_on=now,
+                phone_number=phone_number or None,
+                payload=events,
+                idempotency_key=key)
+            for phone_number, events, key in batches])
+        for phone_number in set([batch[0] or None for batch in batches]):
+            pending_index.mark(pending_index.UPSTREAM, project, phone_number)
+
+    def claim(self, remaining_payload=None):
+        """ take this pending request for a phone, unless changed meanwhile
+
+            Marks it sent or, with `remaining_payload`, keeps only that.
+            Returns False if another process (node) took it first. """
+        now = datetime.datetime.now()
+        changes = {'attempts': self.attempts + 1,
+                   'first_attempt_on': self.first_attempt_on or now,
+                   'last_attempt_on': now}
+        if remaining_payload is None:
+            changes.update({'status': self.SENT_UPSTREAM,
+                            'delivered_on': now})
+        else:
+            changes.update({'payload': remaining_payload})
+        updated = StalledRequest.objects.filter(
+            pk=self.pk,
+            status=self.PENDING_UPSTREAM,
+            altered_on=self.altered_on).update(altered_on=now, **changes)
+        if not updated:
+            return False
+        for attr, value in changes.items():
+            setattr(self, attr, value)
+        self.altered_on = now
+        self.log_attempt(now)
+        return True
+
+    def unclaim(self, items, error=None):
+        """ put back `items` taken by claim(): they were not delivered
+
+            `error` is recorded on the attempt.
+            Returns False if the request changed meanwhile. """
+        now = datetime.datetime.now()
+        if self.status == self.SENT_UPSTREAM:
+            changes = {'status': self.PENDING_UPSTREAM,
+                       'delivered_on': None}
+        else:
+            changes = {'payload': list(items) + list(self.payload)}
+        updated = StalledRequest.objects.filter(
+            pk=self.pk,
+            status=self.status,
+            altered_on=self.altered_on).update(altered_on=now, **changes)
+        if not updated:
+            return False
+        for attr, value in changes.items():
+            setattr(self, attr, value)
+        self.altered_on = now
+        if error is not None:
+            self.attempt_log.filter(attempted_on=self.last_attempt_on) \
+                            .update(error=DeliveryAttempt.error_from(error))
+        pending_index.mark(pending_index.UPSTREAM, self.project,
+                           self.phone_number)
+        return True
+
+    def log_attempt(self, attempted_on, error=None):
+        DeliveryAttempt.objects.create(
+            request=self, attempted_on=attempted_on,
+            error=None if error is None else DeliveryAttempt.error_from(error))
+
+    def claim_downstream(self):
+        """ take this pending request to send it to server
+
+            Records the attempt. Returns False if another process started
+            sending it less than the longest timeout ago. """
+        now = datetime.datetime.now()
+        in_flight_since = now - datetime.timedelta(
+            seconds=max(settings.ADAPTIVE_TIMEOUT_CEILING,
+                        self.project.timeout))
+        first_attempt_on = self.first_attempt_on or now
+        updated = StalledRequest.objects.filter(
+            pk=self.pk,
+            status=self.PENDING_DOWNSTREAM) \
+            .filter(Q(last_attempt_on__isnull=True)
+                    | Q(last_attempt_on__lt=in_flight_since)) \
+            .update(attempts=F('attempts') + 1,
+                    first_attempt_on=first_attempt_on,
+                    last_attempt_on=now,
+                    altered_on=now)
+        if not updated:
+            return False
+        self.attempts += 1
+        self.first_attempt_on = first_attempt_on
+        self.last_attempt_on = now
+        self.altered_on = now
+        return True
 
     def update(self, status):
         self.status = status
         self.altered_on = datetime.datetime.now()
+        if status in (self.SENT_UPSTREAM, self.SENT_DOWNSTREAM) \
+                and self.delivered_on is None:
+            self.delivered_on = self.altered_on
         self.save()
 
+
+@implements_to_string
+class DeliveryAttempt(models.Model):
+    """ Each attempt to deliver a StalledRequest (to server or phone) """
+
+    class Meta:
+        ordering = ('attempted_on', )
+
+    request = models.ForeignKey(StalledRequest, related_name='attempt_log')
+    attempted_on = models.DateTimeField(db_index=True)
+    # None if it went through
+    error = models.CharField(max_length=250, null=True, blank=True)
+
+    def __str__(self):
+        return "{request}@{date}".format(request=self.request_id,
+                                         date=self.attempted_on)
+
+    @classmethod
+    def error_from(cls, error):
+        return '{}'.format(error)[:250]
+
+
+def lease_owner():
+    """ this process, among those of all nodes """
+    return '{node}:{pid}'.format(node=settings.NODE_NAME, pid=os.getpid())
+
+
+def preferred_node(project):
+    """ node of CLUSTER_NODES a project's drain sticks to (rendezvous) """
+    if not settings.CLUSTER_NODES:
+        return settings.NODE_NAME
+    return max(settings.CLUSTER_NODES,
+               key=lambda node: hashlib.sha1('{}:{}'.format(node, project.slug)
+                                             .encode('utf-8')).hexdigest())
+
+
+@implements_to_string
+class DrainLease(models.Model):
+    """ Which node replays a project's stalled requests.
+
+        Nodes sharing the DB drain each project they hold a lease on.
+        Leases are held by a process (`lease_owner()`) and go to
+        processes of the project's preferred node; others take over
+        once it has expired for DRAIN_LEASE_GRACE seconds.
+        Holders renew it while draining. Between runs, the preferred
+        node keeps it reserved (owner `node:`) for DRAIN_LEASE_GRACE
+        seconds, which must exceed the period of `ping_downstream`. """
+
+    project = models.OneToOneField(Project, primary_key=True,
+                                   related_name='drain_lease')
+    owner = models.CharField(max_length=100)
+    expires_on = models.DateTimeField()
+
+    def __str__(self):
+        return "{project}@{owner}".format(project=self.project_id,
+                                          owner=self.owner)
+
+    @classmethod
+    def acquire(cls, project, owner=None):
+        """ take or renew lease for owner. Returns whether it holds it """
+        owner = owner or lease_owner()
+        now = datetime.datetime.now()
+        expires_on = now + datetime.timedelta(
+            seconds=settings.DRAIN_LEASE_DURATION)
+
+        node = owner.rsplit(':', 1)[0]
+        if node == preferred_node(project):
+            expired = Q(expires_on__lt=now)
+        else:
+            expired = Q(expires_on__lt=now - datetime.timedelta(
+                seconds=settings.DRAIN_LEASE_GRACE))
+        # reserved for a next run of this node
+        reserved = Q(owner=cls.reservation(node))
+
+        if cls.objects.filter(project=project) \
+                      .filter(Q(owner=owner) | reserved | expired) \
+                      .update(owner=owner, expires_on=expires_on):
+            return True
+
+        if cls.objects.filter(project=project).exists():
+            return False
+
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(project=project, owner=owner,
+                               expires_on=expires_on)
+        except IntegrityError:
+            # created by another node meanwhile
+            transaction.savepoint_rollback(sid)
+            return False
+        transaction.savepoint_commit(sid)
+        return True
+
+    @classmethod
+    def renew(cls, project, owner=None):
+        """ extend lease if owner still holds it. Returns whether it does """
+        owner = owner or lease_owner()
+        expires_on = datetime.datetime.now() + datetime.timedelta(
+            seconds=settings.DRAIN_LEASE_DURATION)
+        return bool(cls.objects.filter(project=project, owner=owner)
+                               .update(expires_on=expires_on))
+
+    @classmethod
+    def reservation(cls, node):
+        """ owner of a lease kept for any process of node """
+        return '{}:'.format(node)
+
+    @classmethod
+    def release(cls, project, owner=None):
+        """ give lease up. Preferred node keeps it for its next run """
+        owner = owner or lease_owner()
+        node = owner.rsplit(':', 1)[0]
+        leases = cls.objects.filter(project=project, owner=owner)
+        if node == preferred_node(project):
+            leases.update(owner=cls.reservation(node),
+                          expires_on=datetime.datetime.now()
+                          + datetime.timedelta(
+                              seconds=settings.DRAIN_LEASE_GRACE))
+        else:
+            leases.delete()
+
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class PendingIndex(object):
+    """ Whether a queue holds pending requests, without querying the DB.
+
+        Flags are kept in Django's cache: per-process by default, shared
+        when a shared backend (memcached, DB) is configured.
+        Enqueuing sets the flag. Dequeuing recomputes it from the DB.
+        Flags expire after PENDING_INDEX_TTL seconds so that a per-process
+        cache catches up with rows enqueued or dequeued by other
+        processes (management commands, other workers). """
+
+    UPSTREAM = 'up'
+    DOWNSTREAM = 'down'
+
+    def _key(self, direction, project, phone_number=None):
+        return 'isafonda:pending:{direction}:{project}:{phone}'.format(
+            direction=direction, project=project.slug,
+            phone=phone_number or '')
+
+    def _query(self, direction, project, phone_number=None):
+        from isafonda.models import StalledRequest
+        if direction == self.UPSTREAM:
+            qs = StalledRequest.objects.filter(
+                project=project,
+                status=StalledRequest.PENDING_UPSTREAM)
+            if phone_number is None:
+                qs = qs.filter(phone_number__isnull=True)
+            else:
+                qs = qs.filter(phone_number=phone_number)
+        else:
+            qs = StalledRequest.objects.filter(
+                project=project,
+                status=StalledRequest.PENDING_DOWNSTREAM)
+        return qs.exists()
+
+    def _store(self, direction, project, phone_number, value):
+        cache.set(self._key(direction, project, phone_number),
+                  bool(value), settings.PENDING_INDEX_TTL)
+
+    def _get(self, direction, project, phone_number=None):
+        value = cache.get(self._key(direction, project, phone_number))
+        if value is None:
+            value = self._query(direction, project, phone_number)
+            self._store(direction, project, phone_number, value)
+        return value
+
+    def mark(self, direction, project, phone_number=None):
+        """ a request has been enqueued """
+        self._store(direction, project, phone_number, True)
+
+    def refresh(self, direction, project, phone_number=None):
+        """ requests have been dequeued: check what remains """
+        self._store(direction, project, phone_number,
+                    self._query(direction, project, phone_number))
+
+    def has_pending_upstream(self, project, phone_number=None, shared=True):
+        """ messages for phone_number, or without target if `shared` """
+        if shared and self._get(self.UPSTREAM, project):
+            return True
+        if project.reply_same_phone and phone_number is not None:
+            return self._get(self.UPSTREAM, project, phone_number)
+        return False
+
+    def has_pending_downstream(self, project):
+        return self._get(self.DOWNSTREAM, project)
+
+# Pending Holder Initializer
+pending_index = PendingIndex()
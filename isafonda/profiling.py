@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import cProfile
+import datetime
+import os
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+
+PROFILE_EXT = '.prof'
+
+
+def should_profile(project_slug, requested=False):
+    """ whether to profile, for projects listed in PROFILE_PROJECTS
+
+        `requested` (header) forces it, otherwise project's sample rate. """
+    rate = settings.PROFILE_PROJECTS.get(project_slug)
+    if rate is None:
+        return False
+    return requested or random.random() < rate
+
+
+def profile_files(project_slug=None):
+    """ paths of collected profiles, oldest first """
+    if not os.path.isdir(settings.PROFILE_DIR):
+        return []
+    names = sorted([name for name in os.listdir(settings.PROFILE_DIR)
+                    if name.endswith(PROFILE_EXT)])
+    if project_slug is not None:
+        names = [name for name in names
+                 if name.split('--', 1)[1].rsplit('--', 1)[0] == project_slug]
+    return [os.path.join(settings.PROFILE_DIR, name) for name in names]
+
+
+def rotate():
+    """ keep only the PROFILE_MAX_FILES most recent profiles """
+    files = profile_files()
+    for path in files[:max(0, len(files) - settings.PROFILE_MAX_FILES)]:
+        try:
+            os.remove(path)
+        except OSError:
+            # removed by another process
+            pass
+
+
+def dump(profile, name, project_slug):
+    if not os.path.isdir(settings.PROFILE_DIR):
+        os.makedirs(settings.PROFILE_DIR)
+    filename = '{date}--{project}--{name}{ext}'.format(
+        date=datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+        project=project_slug, name=name, ext=PROFILE_EXT)
+    profile.dump_stats(os.path.join(settings.PROFILE_DIR, filename))
+    rotate()
+
+
+@contextmanager
+def profiled(name, project_slug, requested=False):
+    """ profile the block if project is sampled, dump it to PROFILE_DIR """
+    if not should_profile(project_slug, requested):
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        dump(profile, name, project_slug)
+
+
+class ProfilingMiddleware(object):
+    """ profiles fondaSMS and events views of projects in PROFILE_PROJECTS
+
+        Should be last of MIDDLEWARE_CLASSES as it calls the view itself. """
+
+    PROFILED_VIEWS = ('fondasms_handler', 'external_events_handler')
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        project_slug = view_kwargs.get('project_slug')
+        if project_slug not in settings.PROFILE_PROJECTS \
+                or view_func.__name__ not in self.PROFILED_VIEWS:
+            return None
+
+        meta_name = 'HTTP_{}'.format(
+            settings.PROFILE_HEADER.upper().replace('-', '_'))
+        requested = bool(request.META.get(meta_name))
+        with profiled(view_func.__name__, project_slug, requested):
+            return view_func(request, *view_args, **view_kwargs)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import json
+import logging
+import os
+import threading
+from abc import ABCMeta, abstractmethod
+from importlib import import_module
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from isafonda._compat import with_metaclass
+from isafonda.fleet import fleet
+from isafonda.models import StalledRequest
+
+logger = logging.getLogger(__name__)
+
+
+class PushError(Exception):
+    pass
+
+
+class PushBackend(with_metaclass(ABCMeta, object)):
+    """ delivers fondaSMS messages to phones listening on broker queues.
+
+        Phones of a project share a queue; each also has its own.
+        Subclasses implement `publish()`. """
+
+    def queue_name(self, project, phone_number=None):
+        if phone_number is None:
+            return settings.PUSH_PROJECT_QUEUE.format(project=project.slug)
+        return settings.PUSH_PHONE_QUEUE.format(project=project.slug,
+                                                phone_number=phone_number)
+
+    def encode(self, events):
+        """ fondaSMS response body sending events """
+        return json.dumps({'events': [{'event': 'send',
+                                       'messages': events}]})
+
+    def push(self, project, phone_number, events):
+        self.publish(self.queue_name(project, phone_number),
+                     self.encode(events))
+
+    @abstractmethod
+    def publish(self, queue, body):
+        """ send body to queue. Raises PushError """
+
+    def close(self):
+        """ release broker connection, if any """
+
+
+class LocalPushBackend(PushBackend):
+    """ in-memory stand-in for a broker (development, tests) """
+
+    def __init__(self):
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def publish(self, queue, body):
+        with self.lock:
+            self.queues.setdefault(queue, []).append(body)
+
+    def consume(self, queue):
+        with self.lock:
+            return self.queues.pop(queue, [])
+
+
+class AMQPPushBackend(PushBackend):
+    """ publishes to the AMQP broker fondaSMS phones are connected to.
+
+        One connection per process, opened on first publish and
+        reopened once if broker closed it. Requires `pika`. """
+
+    def __init__(self):
+        try:
+            import pika
+        except ImportError:
+            raise ImproperlyConfigured(
+                "AMQPPushBackend requires the `pika` package.")
+        self.pika = pika
+        # connections are not thread-safe
+        self.lock = threading.Lock()
+        self.connection = None
+        self.channel = None
+        self.pid = None
+        self.declared = set()
+
+    def _channel(self):
+        # connection can't be shared with forked workers
+        if self.connection is None or not self.connection.is_open \
+                or self.pid != os.getpid():
+            self.connection = self.pika.BlockingConnection(
+                self.pika.URLParameters(settings.PUSH_AMQP_URL))
+            self.channel = self.connection.channel()
+            self.pid = os.getpid()
+            self.declared = set()
+        return self.channel
+
+    def publish(self, queue, body):
+        with self.lock:
+            for reconnect in (True, False):
+                try:
+                    channel = self._channel()
+                    if queue not in self.declared:
+                        channel.queue_declare(queue=queue, durable=True)
+                        self.declared.add(queue)
+                    channel.basic_publish(exchange='', routing_key=queue,
+                                          body=body)
+                    return
+                except self.pika.exceptions.AMQPError as exp:
+                    # broker may have dropped an idle connection
+                    self._close()
+                    if not reconnect:
+                        raise PushError(exp)
+
+    def _close(self):
+        try:
+            if self.connection is not None and self.connection.is_open \
+                    and self.pid == os.getpid():
+                self.connection.close()
+        except self.pika.exceptions.AMQPError:
+            pass
+        self.connection = self.channel = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+_backend = None
+
+
+def get_backend():
+    """ configured PushBackend instance or None if push is disabled """
+    global _backend
+    if settings.PUSH_BACKEND is None:
+        return None
+    if _backend is None:
+        module_name, class_name = settings.PUSH_BACKEND.rsplit('.', 1)
+        _backend = getattr(import_module(module_name), class_name)()
+    return _backend
+
+
+def push_pending(project, phone_number=None):
+    """ send pending messages to phones right away instead of next poll
+
+        Messages for `phone_number` go to its own queue, those without
+        target phone to the project queue. Pushes a single batch
+        (`project.max_items`): the rest waits for next push or poll.
+        Returns the number of messages pushed. Messages are put back
+        in queue if the broker can't be reached. """
+    backend = get_backend()
+    if backend is None:
+        return 0
+
+    if not project.reply_same_phone:
+        phone_number = None
+
+    claimed = StalledRequest.get_pending_push(project, phone_number)
+    events = [event for _, items in claimed for event in items]
+    if not events:
+        return 0
+
+    try:
+        backend.push(project, phone_number, events)
+    except PushError as exp:
+        # back in queue, at their place
+        for sreq, items in claimed:
+            if not sreq.unclaim(items, error=exp):
+                # rest of the request was taken meanwhile
+                logger.warning("Unable to put back messages of {}: "
+                               "queued again.".format(sreq))
+                StalledRequest.from_downstream(project, items, phone_number)
+        return 0
+
+    if phone_number is not None:
+        fleet.handed(project, phone_number, len(events))
+    return len(events)
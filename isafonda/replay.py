@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from django.conf import settings
+from django.db import connection
+
+from isafonda.models import StalledRequest
+from isafonda.pending import pending_index
+from isafonda.profiling import profiled
+from isafonda.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+
+def partition_key(phone_number, payload):
+    """ events from the same phone (or sender) must reach server in order """
+    if phone_number:
+        return phone_number
+    try:
+        return payload.get('from') or None
+    except AttributeError:
+        return None
+
+
+def partition_backlog(project):
+    """ ids of requests pending for server, grouped by partition (FIFO) """
+    rows = list(StalledRequest.objects.filter(
+        project=project,
+        status=StalledRequest.PENDING_DOWNSTREAM)
+        .order_by('created_on', 'id')
+        .values_list('id', 'phone_number'))
+
+    # payload is only needed (unpickled) for requests without phone
+    senders = {}
+    for ids in chunked([sreq_id for sreq_id, phone_number in rows
+                        if not phone_number], 500):
+        for sreq in StalledRequest.objects.filter(id__in=ids) \
+                                          .only('id', 'payload'):
+            senders[sreq.id] = partition_key(None, sreq.payload)
+
+    partitions = OrderedDict()
+    for sreq_id, phone_number in rows:
+        key = phone_number or senders.get(sreq_id)
+        partitions.setdefault(key, []).append(sreq_id)
+    return partitions
+
+
+def replay_one(sreq_id):
+    """ True if delivered, False if not,
+        None if no longer pending or being sent by another process """
+    try:
+        sreq = StalledRequest.objects.get(
+            id=sreq_id, status=StalledRequest.PENDING_DOWNSTREAM)
+    except StalledRequest.DoesNotExist:
+        # already processed by someone else
+        return None
+
+    with profiled('drain', sreq.project_id):
+        return sreq.retry_downstream()
+
+
+def drain_partition(ids, stats, lock, keep_going=None):
+    """ replay requests one after another, stopping at first failure
+
+        Later requests of a failed partition are left pending so that
+        they are not delivered ahead of the one that failed.
+        Also stops when `keep_going()` returns False. """
+    for index, sreq_id in enumerate(ids):
+        if keep_going is not None and not keep_going():
+            with lock:
+                stats['skipped'] += len(ids) - index
+            return False
+
+        try:
+            delivered = replay_one(sreq_id)
+        except Exception:
+            # DB locked, unreadable payload...: retried on next run
+            logger.exception("Unable to replay request #{}".format(sreq_id))
+            delivered = False
+
+        # handled by another process: its followers too
+        if delivered is None:
+            with lock:
+                stats['skipped'] += len(ids) - index - 1
+            return False
+
+        if delivered:
+            with lock:
+                stats['sent'] += 1
+            continue
+
+        with lock:
+            stats['failed'] += 1
+            stats['skipped'] += len(ids) - index - 1
+        return False
+    return True
+
+
+def replay_downstream(project, workers=None, renew=None):
+    """ send stalled requests to server, partitions in parallel
+
+        `renew` is called every DRAIN_LEASE_RENEW_INTERVAL seconds;
+        replay stops once it returns False (lease lost).
+        Returns a dict of counters (sent, failed, skipped, partitions)
+        and whether replay was interrupted. """
+    if workers is None:
+        workers = settings.REPLAY_WORKERS
+    workers = max(1, int(workers))
+
+    partitions = partition_backlog(project)
+    stats = {'sent': 0, 'failed': 0, 'skipped': 0,
+             'partitions': len(partitions), 'interrupted': False}
+    lock = threading.Lock()
+    renewed = {'on': time.time()}
+
+    def keep_going():
+        if renew is None:
+            return True
+        with lock:
+            if not stats['interrupted'] and time.time() - renewed['on'] \
+                    >= settings.DRAIN_LEASE_RENEW_INTERVAL:
+                stats['interrupted'] = not renew()
+                renewed['on'] = time.time()
+            return not stats['interrupted']
+
+    pending = queue.Queue()
+    for ids in partitions.values():
+        pending.put(ids)
+
+    def worker():
+        try:
+            while True:
+                try:
+                    ids = pending.get_nowait()
+                except queue.Empty:
+                    return
+                drain_partition(ids, stats, lock, keep_going)
+        finally:
+            # each thread gets its own DB connection
+            connection.close()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(partitions)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    pending_index.refresh(pending_index.DOWNSTREAM, project)
+    return stats
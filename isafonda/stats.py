@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Min
+
+from isafonda.latency import percentile
+from isafonda.models import Project, StalledRequest
+
+STATS_CACHE_KEY = 'isafonda:queue_stats'
+
+# which pending queue each sent status drains
+DRAINS = {
+    StalledRequest.SENT_UPSTREAM: StalledRequest.PENDING_UPSTREAM,
+    StalledRequest.SENT_DOWNSTREAM: StalledRequest.PENDING_DOWNSTREAM,
+}
+
+
+def compute_queue_stats():
+    """ depth, oldest pending age, drain rate and delivery latency
+        per project and status
+
+        One GROUP BY over (project, status) plus one for recent deliveries
+        and one for their latencies. """
+    now = datetime.datetime.now()
+    window = settings.STATS_DRAIN_WINDOW
+    since = now - datetime.timedelta(seconds=window)
+
+    stats = {}
+    for project in Project.objects.all():
+        stats[project.slug] = {
+            'name': project.name,
+            'queues': dict([(status, {'label': label,
+                                       'depth': 0,
+                                       'oldest_age': None,
+                                       'drain_rate': 0,
+                                       'latency': None})
+                            for status, label
+                            in StalledRequest.STATUSES.items()])}
+
+    depths = StalledRequest.objects.values('project', 'status') \
+                                   .annotate(depth=Count('id'),
+                                             oldest=Min('created_on')) \
+                                   .order_by()
+    for row in depths:
+        queue = stats.get(row['project'], {}).get('queues', {}) \
+                     .get(row['status'])
+        if queue is None:
+            continue
+        queue['depth'] = row['depth']
+        if row['status'] not in DRAINS and row['oldest'] is not None:
+            queue['oldest_age'] = (now - row['oldest']).total_seconds()
+
+    drained = StalledRequest.objects.filter(status__in=DRAINS.keys(),
+                                            delivered_on__gte=since) \
+                                    .values('project', 'status') \
+                                    .annotate(drained=Count('id')) \
+                                    .order_by()
+    for row in drained:
+        queue = stats.get(row['project'], {}).get('queues', {}) \
+                     .get(DRAINS[row['status']])
+        if queue is None:
+            continue
+        # per minute
+        queue['drain_rate'] = row['drained'] * 60 / window
+
+    for (slug, status), latencies in delivery_latencies().items():
+        queue = stats.get(slug, {}).get('queues', {}).get(status)
+        if queue is None:
+            continue
+        queue['latency'] = {'samples': len(latencies),
+                            'p50': percentile(latencies, 50),
+                            'p95': percentile(latencies, 95),
+                            'p99': percentile(latencies, 99)}
+
+    return {'generated_on': now.isoformat(),
+            'drain_window': window,
+            'latency_window': settings.STATS_LATENCY_WINDOW,
+            'projects': stats}
+
+
+def delivery_latencies():
+    """ seconds from enqueue to delivery of requests delivered lately
+
+        {(project slug, pending status): [latency, ...]} """
+    since = datetime.datetime.now() - datetime.timedelta(
+        seconds=settings.STATS_LATENCY_WINDOW)
+    rows = StalledRequest.objects.filter(delivered_on__gte=since) \
+                                 .order_by('-delivered_on') \
+                                 .values_list('project', 'status',
+                                              'created_on', 'delivered_on')
+    latencies = {}
+    for slug, status, created_on, delivered_on in \
+            rows[:settings.STATS_LATENCY_MAX_SAMPLES]:
+        if status not in DRAINS:
+            continue
+        latencies.setdefault((slug, DRAINS[status]), []).append(
+            (delivered_on - created_on).total_seconds())
+    return latencies
+
+
+def queue_stats():
+    """ compute_queue_stats() cached for STATS_CACHE_TTL seconds """
+    stats = cache.get(STATS_CACHE_KEY)
+    if stats is None:
+        stats = compute_queue_stats()
+        cache.set(STATS_CACHE_KEY, stats, settings.STATS_CACHE_TTL)
+    return stats
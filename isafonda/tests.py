@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
+
+from isafonda import push
+from isafonda.blobs import blob_store
+from isafonda.fleet import fleet
+from isafonda.models import (FondaSMSRequest, Project, StalledRequest,
+                             DrainLease, preferred_node)
+from isafonda.utils import JSONArrayReader, PayloadTooLarge
+from isafonda.views import route_events
+
+
+def read(data, **kwargs):
+    return list(JSONArrayReader(io.BytesIO(data), **kwargs))
+
+
+class JSONArrayReaderTest(SimpleTestCase):
+
+    EVENTS = [{'to': '+22376000000', 'message': "Bonjour é ☺"},
+              2.5, -12, 1e3, 1234567, True, None, "text", [1, [2]]]
+
+    def test_whole(self):
+        self.assertEqual(read(json.dumps(self.EVENTS).encode('utf-8')),
+                         self.EVENTS)
+
+    def test_empty(self):
+        self.assertEqual(read(b' [ ] '), [])
+
+    def test_split_tokens(self):
+        # every chunk boundary: numbers, strings, multi-byte characters
+        data = json.dumps(self.EVENTS, ensure_ascii=False).encode('utf-8')
+        for chunk_size in range(1, 12):
+            self.assertEqual(read(data, chunk_size=chunk_size), self.EVENTS)
+
+    def test_split_number(self):
+        self.assertEqual(read(b'[2.5]', chunk_size=2), [2.5])
+        self.assertEqual(read(b'[1e3, 12]', chunk_size=2), [1000.0, 12])
+        self.assertEqual(read(b'[-7]', chunk_size=1), [-7])
+
+    def test_malformed(self):
+        for data in (b'{"a": 1}', b'[1, 2', b'[1 2]', b'[2x]', b'[1,]', b''):
+            with self.assertRaises(ValueError):
+                read(data, chunk_size=2)
+
+    def test_max_size(self):
+        data = json.dumps(list(range(100))).encode('utf-8')
+        self.assertEqual(len(read(data, max_size=len(data))), 100)
+        with self.assertRaises(PayloadTooLarge):
+            read(data, chunk_size=16, max_size=len(data) - 1)
+
+    def test_max_item_size(self):
+        data = json.dumps([{'message': 'x' * 100}, 1]).encode('utf-8')
+        self.assertEqual(len(read(data, max_item_size=200)), 2)
+        for chunk_size in (8, 1024):
+            with self.assertRaises(PayloadTooLarge):
+                read(data, chunk_size=chunk_size, max_item_size=50)
+
+
+class MultipartTest(TestCase):
+
+    POST = {'action': 'incoming', 'message_type': 'mms',
+            'from': '+22376000000', 'message': "Photo"}
+    IMAGE = b'\x89PNG' + os.urandom(200000)
+
+    def setUp(self):
+        self.blob_dir = tempfile.mkdtemp()
+        self.settings_override = self.settings(BLOB_STORE_DIR=self.blob_dir)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.blob_dir)
+
+    def fondareq(self):
+        return FondaSMSRequest.from_post(self.POST, {
+            'mms_part_1': SimpleUploadedFile('photo.png', self.IMAGE,
+                                             'image/png')})
+
+    def check_body(self, fondareq):
+        body, headers = fondareq.encoded()
+        self.assertEqual(headers['Content-Type'], body.content_type)
+        data = b''
+        while True:
+            chunk = body.read(4096)
+            if not chunk:
+                break
+            data += chunk
+        self.assertEqual(len(data), len(body))
+        boundary = body.boundary.encode('ascii')
+        self.assertTrue(data.startswith(b'--' + boundary))
+        self.assertTrue(data.endswith(b'--' + boundary + b'--\r\n'))
+        self.assertIn(b'name="mms_part_1"; filename="photo.png"\r\n'
+                      b'Content-Type: image/png\r\n\r\n'
+                      + self.IMAGE + b'\r\n', data)
+        self.assertIn(b'name="message"\r\n\r\nPhoto\r\n', data)
+
+    def test_live(self):
+        # forwarded live: streamed from upload, nothing stored
+        fondareq = self.fondareq()
+        self.check_body(fondareq)
+        self.assertEqual(list(blob_store.digests()), [])
+
+    def test_queued(self):
+        project = Project.objects.create(slug='mms', name="MMS",
+                                         url='http://localhost/')
+        fondareq = self.fondareq()
+        # a failed live attempt read the upload already
+        fondareq.encoded()[0].read()
+        sreq = StalledRequest.from_upstream(project, None, fondareq)
+
+        self.assertEqual(len(list(blob_store.digests())), 1)
+        self.check_body(FondaSMSRequest(
+            StalledRequest.objects.get(id=sreq.id).payload))
+
+    def test_missing_blob(self):
+        fondareq = self.fondareq()
+        fondareq.spill()
+        for digest in blob_store.digests():
+            blob_store.remove(digest)
+        self.assertEqual(fondareq.missing_files, ['mms_part_1'])
+        body, headers = fondareq.without_files(['mms_part_1']).encoded()
+        self.assertEqual(headers, {})
+
+
+class RouteEventsTest(SimpleTestCase):
+
+    EVENTS = [{'to': '1', 'message': "a", 'phone_number': '+223700'},
+              {'to': '2', 'message': "b"}]
+
+    def route(self, reply_same_phone, phone_number=None):
+        project = Project(slug='route', max_items=10,
+                          reply_same_phone=reply_same_phone)
+        return [(target, len(rows)) for target, rows, _ in route_events(
+            project, self.EVENTS, phone_number, 'key', 0)]
+
+    def test_per_phone(self):
+        self.assertEqual(self.route(True), [('+223700', 1), (None, 1)])
+        self.assertEqual(self.route(True, '+223800'),
+                         [('+223700', 1), ('+223800', 1)])
+
+    def test_shared_only(self):
+        # phones of such projects only get messages without target
+        self.assertEqual(self.route(False), [(None, 2)])
+        self.assertEqual(self.route(False, '+223800'), [(None, 2)])
+
+
+class FailingPushBackend(push.PushBackend):
+    """ broker that can't be reached """
+
+    def publish(self, queue, body):
+        raise push.PushError("unreachable")
+
+
+@override_settings(PUSH_BACKEND='isafonda.push.LocalPushBackend',
+                   MAX_IN_FLIGHT_PER_PHONE=None)
+class LocalPushBackendTest(TestCase):
+
+    PHONE = '+22376000000'
+
+    def setUp(self):
+        cache.clear()
+        push._backend = None
+        self.project = Project.objects.create(
+            slug='push', name="Push", url='http://localhost/',
+            reply_same_phone=True, max_items=2)
+
+    def tearDown(self):
+        push._backend = None
+
+    def add(self, events, phone_number=None):
+        StalledRequest.from_downstream(self.project, events, phone_number)
+
+    def consume(self, phone_number=None):
+        backend = push.get_backend()
+        return [json.loads(body)['events'][0]['messages']
+                for body in backend.consume(
+                    backend.queue_name(self.project, phone_number))]
+
+    def test_queues(self):
+        self.add([{'to': '1', 'message': "shared"}])
+        self.add([{'to': '2', 'message': "private"}], self.PHONE)
+
+        self.assertEqual(push.push_pending(self.project, self.PHONE), 1)
+        self.assertEqual(self.consume(self.PHONE),
+                         [[{'to': '2', 'message': "private"}]])
+        # shared messages never go to a phone's queue
+        self.assertEqual(self.consume(), [])
+
+        self.assertEqual(push.push_pending(self.project), 1)
+        self.assertEqual(self.consume(),
+                         [[{'to': '1', 'message': "shared"}]])
+        self.assertFalse(StalledRequest.objects.filter(
+            status=StalledRequest.PENDING_UPSTREAM).exists())
+
+    def test_single_batch(self):
+        self.add([{'to': '1', 'message': "a"}, {'to': '2', 'message': "b"},
+                  {'to': '3', 'message': "c"}])
+
+        self.assertEqual(push.push_pending(self.project), 2)
+        self.assertEqual(len(self.consume()), 1)
+        remaining = StalledRequest.objects.get(
+            status=StalledRequest.PENDING_UPSTREAM)
+        self.assertEqual(remaining.payload, [{'to': '3', 'message': "c"}])
+
+    def test_push_is_not_a_poll(self):
+        self.add([{'to': '2', 'message': "private"}], self.PHONE)
+        push.push_pending(self.project, self.PHONE)
+        self.assertNotIn(self.PHONE, fleet._active(self.project))
+
+    def test_disabled(self):
+        self.add([{'to': '1', 'message': "shared"}])
+        with self.settings(PUSH_BACKEND=None):
+            self.assertEqual(push.push_pending(self.project), 0)
+        self.assertTrue(StalledRequest.objects.filter(
+            status=StalledRequest.PENDING_UPSTREAM).exists())
+
+
+@override_settings(PUSH_BACKEND='isafonda.tests.FailingPushBackend',
+                   MAX_IN_FLIGHT_PER_PHONE=None)
+class FailingPushBackendTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        push._backend = None
+        self.project = Project.objects.create(
+            slug='push', name="Push", url='http://localhost/',
+            reply_same_phone=True, max_items=1)
+
+    def tearDown(self):
+        push._backend = None
+
+    def add(self, events):
+        return StalledRequest.from_downstream(
+            self.project, events, idempotency_key='key-{}'.format(
+                StalledRequest.objects.count()))
+
+    def test_put_back_in_place(self):
+        first = self.add([{'to': '1', 'message': "a"}])
+        second = self.add([{'to': '2', 'message': "b"}])
+
+        self.assertEqual(push.push_pending(self.project), 0)
+
+        self.assertEqual(StalledRequest.objects.count(), 2)
+        for sreq, key in ((first, 'key-0'), (second, 'key-1')):
+            sreq = StalledRequest.objects.get(id=sreq.id)
+            self.assertEqual(sreq.status, StalledRequest.PENDING_UPSTREAM)
+            self.assertIsNone(sreq.delivered_on)
+            self.assertEqual(sreq.idempotency_key, key)
+
+        # FIFO still holds for polls
+        self.assertEqual(
+            StalledRequest.get_pending_upstream(self.project),
+            [{'to': '1', 'message': "a"}])
+        self.assertEqual(
+            StalledRequest.get_pending_upstream(self.project),
+            [{'to': '2', 'message': "b"}])
+
+    def test_partial_claim_restored(self):
+        events = [{'to': '1', 'message': "a"}, {'to': '2', 'message': "b"}]
+        sreq = self.add(events)
+
+        self.assertEqual(push.push_pending(self.project), 0)
+
+        sreq = StalledRequest.objects.get()
+        self.assertEqual(sreq.status, StalledRequest.PENDING_UPSTREAM)
+        self.assertEqual(sreq.payload, events)
+        self.assertEqual([attempt.error for attempt in sreq.attempt_log.all()],
+                         ["unreachable"])
+
+
+@override_settings(CLUSTER_NODES=('node-a', 'node-b'), DRAIN_LEASE_GRACE=300)
+class DrainLeaseTest(TestCase):
+
+    def setUp(self):
+        self.project = Project.objects.create(slug='lease', name="Lease",
+                                              url='http://localhost/')
+        self.preferred = preferred_node(self.project)
+        self.other = [node for node in ('node-a', 'node-b')
+                      if node != self.preferred][0]
+
+    def owner(self, node, pid=1):
+        return '{}:{}'.format(node, pid)
+
+    def expire(self, seconds_ago):
+        DrainLease.objects.filter(project=self.project).update(
+            expires_on=datetime.datetime.now()
+            - datetime.timedelta(seconds=seconds_ago))
+
+    def test_single_holder(self):
+        self.assertTrue(DrainLease.acquire(self.project,
+                                           self.owner(self.preferred)))
+        # held: not even by another process of the same node
+        self.assertFalse(DrainLease.acquire(self.project,
+                                            self.owner(self.preferred, 2)))
+        self.assertFalse(DrainLease.acquire(self.project,
+                                            self.owner(self.other)))
+        self.assertTrue(DrainLease.renew(self.project,
+                                         self.owner(self.preferred)))
+        self.assertFalse(DrainLease.renew(self.project,
+                                          self.owner(self.other)))
+
+    def test_affinity(self):
+        DrainLease.acquire(self.project, self.owner(self.preferred))
+        DrainLease.release(self.project, self.owner(self.preferred))
+
+        # kept for next run of preferred node
+        self.assertFalse(DrainLease.acquire(self.project,
+                                            self.owner(self.other)))
+        self.assertTrue(DrainLease.acquire(self.project,
+                                           self.owner(self.preferred, 2)))
+
+    def test_failover(self):
+        DrainLease.acquire(self.project, self.owner(self.preferred))
+        DrainLease.release(self.project, self.owner(self.preferred))
+
+        self.expire(10)
+        self.assertFalse(DrainLease.acquire(self.project,
+                                            self.owner(self.other)))
+        self.expire(301)
+        self.assertTrue(DrainLease.acquire(self.project,
+                                           self.owner(self.other)))
+        # lost lease can't be renewed
+        self.assertFalse(DrainLease.renew(self.project,
+                                          self.owner(self.preferred)))
+
+        # handed back once done
+        DrainLease.release(self.project, self.owner(self.other))
+        self.assertFalse(DrainLease.objects.exists())
+
+    def test_preferred_takes_expired(self):
+        DrainLease.acquire(self.project, self.owner(self.other))
+        self.expire(1)
+        self.assertTrue(DrainLease.acquire(self.project,
+                                           self.owner(self.preferred)))
+
+
+class ClaimTest(TestCase):
+
+    def setUp(self):
+        self.project = Project.objects.create(slug='claim', name="Claim",
+                                              url='http://localhost/')
+
+    def test_claim(self):
+        sreq = StalledRequest.from_downstream(self.project, [1, 2, 3])
+        concurrent = StalledRequest.objects.get(id=sreq.id)
+
+        self.assertTrue(sreq.claim([3]))
+        # changed meanwhile
+        self.assertFalse(concurrent.claim())
+
+        sreq = StalledRequest.objects.get(id=sreq.id)
+        self.assertEqual(sreq.status, StalledRequest.PENDING_UPSTREAM)
+        self.assertEqual(sreq.payload, [3])
+        self.assertIsNone(sreq.delivered_on)
+
+        self.assertTrue(sreq.claim())
+        sreq = StalledRequest.objects.get(id=sreq.id)
+        self.assertEqual(sreq.status, StalledRequest.SENT_UPSTREAM)
+        self.assertEqual(sreq.attempts, 2)
+        self.assertIsNotNone(sreq.delivered_on)
+
+        # each attempt is kept
+        attempts = list(sreq.attempt_log.all())
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(attempts[-1].attempted_on, sreq.last_attempt_on)
+        self.assertEqual([attempt.error for attempt in attempts],
+                         [None, None])
+
+    def test_claim_downstream(self):
+        sreq = StalledRequest.objects.create(
+            project=self.project, status=StalledRequest.PENDING_DOWNSTREAM,
+            originated_on=datetime.datetime.now(), payload={'action': 'test'})
+        concurrent = StalledRequest.objects.get(id=sreq.id)
+
+        self.assertTrue(sreq.claim_downstream())
+        # being sent by another process
+        self.assertFalse(concurrent.claim_downstream())
+
+        # that process is long gone
+        StalledRequest.objects.filter(id=sreq.id).update(
+            last_attempt_on=datetime.datetime.now()
+            - datetime.timedelta(hours=1))
+        self.assertTrue(concurrent.claim_downstream())
+        self.assertEqual(StalledRequest.objects.get(id=sreq.id).attempts, 2)
+
+        StalledRequest.objects.filter(id=sreq.id).update(
+            status=StalledRequest.SENT_DOWNSTREAM,
+            last_attempt_on=None)
+        self.assertFalse(sreq.claim_downstream())
+
+
+@override_settings(MAX_IN_FLIGHT_PER_PHONE=None)
+class PendingUpstreamTest(TestCase):
+
+    PHONE_A = '+22376000001'
+    PHONE_B = '+22376000002'
+
+    def setUp(self):
+        cache.clear()
+        self.project = Project.objects.create(
+            slug='fleet', name="Fleet", url='http://localhost/',
+            reply_same_phone=True, max_items=4)
+
+    def add(self, events, phone_number=None):
+        return StalledRequest.from_downstream(self.project, events,
+                                              phone_number)
+
+    def poll(self, phone_number):
+        return StalledRequest.get_pending_upstream(
+            self.project, phone_number=phone_number)
+
+    def test_fifo(self):
+        self.add(['s1'])
+        self.add(['a1'], self.PHONE_A)
+        self.add(['s2'])
+        self.add(['b1'], self.PHONE_B)
+        self.add(['a2'], self.PHONE_A)
+
+        self.assertEqual(self.poll(self.PHONE_A), ['s1', 'a1', 's2', 'a2'])
+        self.assertEqual(self.poll(self.PHONE_B), ['b1'])
+
+    def test_share(self):
+        self.add(['s1', 's2', 's3', 's4', 's5', 's6'])
+        self.add(['a1'], self.PHONE_A)
+        fleet.seen(self.project, self.PHONE_B)
+
+        # ceil(4 / 2 active phones) shared messages each
+        self.assertEqual(self.poll(self.PHONE_A), ['s1', 's2', 'a1'])
+        self.assertEqual(self.poll(self.PHONE_B), ['s3', 's4'])
+        self.assertEqual(self.poll(self.PHONE_A), ['s5', 's6'])
+
+    def test_partial_claim(self):
+        sreq = self.add(['s1', 's2', 's3', 's4', 's5'])
+
+        self.assertEqual(self.poll(self.PHONE_A), ['s1', 's2', 's3', 's4'])
+        sreq = StalledRequest.objects.get(id=sreq.id)
+        self.assertEqual(sreq.status, StalledRequest.PENDING_UPSTREAM)
+        self.assertEqual(sreq.payload, ['s5'])
+
+        self.assertEqual(self.poll(self.PHONE_A), ['s5'])
+        self.assertEqual(StalledRequest.objects.get(id=sreq.id).status,
+                         StalledRequest.SENT_UPSTREAM)
+
+    @override_settings(MAX_IN_FLIGHT_PER_PHONE=2)
+    def test_in_flight(self):
+        self.add(['a1', 'a2', 'a3'], self.PHONE_A)
+
+        self.assertEqual(self.poll(self.PHONE_A), ['a1', 'a2'])
+        # no report yet on those
+        self.assertEqual(self.poll(self.PHONE_A), [])
+
+        fleet.acknowledge(self.project, self.PHONE_A, 'queued')
+        self.assertEqual(self.poll(self.PHONE_A), [])
+
+        fleet.acknowledge(self.project, self.PHONE_A, 'sent')
+        self.assertEqual(self.poll(self.PHONE_A), ['a3'])
+        self.assertEqual(fleet.in_flight(self.project, self.PHONE_A), 2)
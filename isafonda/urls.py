@@ -6,6 +6,9 @@ admin.autodiscover()
 urlpatterns = patterns('',
 
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^status/?$', 'isafonda.views.status_dashboard', name='status'),
+    url(r'^status\.json$', 'isafonda.views.status_json',
+        name='status_json'),
     url(r'^(?P<project_slug>[a-zA-Z0-9\_\-\.]+)/?$',
         'isafonda.views.fondasms_handler',
         name='fondasms_project'),
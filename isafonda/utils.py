@@ -4,9 +4,14 @@
 
 from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
+import codecs
 import datetime
+import hashlib
+import json
 
 import requests
+from django.conf import settings
+from django.db import transaction
 from requests.exceptions import RequestException
 
 
@@ -31,6 +36,138 @@ def to_jstimestamp(adate):
         return int(to_timestamp(adate)) * 1000
 
 
+def make_idempotency_key(*parts):
+    """ stable digest of JSON-serializable parts """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True)
+                        .encode('utf-8')).hexdigest()
+
+
+def idempotency_header(key):
+    if key is None:
+        return {}
+    return {settings.IDEMPOTENCY_HEADER: key}
+
+
+def idempotency_key_from(request):
+    """ key sent by the other side in header, if any """
+    meta_name = 'HTTP_{}'.format(
+        settings.IDEMPOTENCY_HEADER.upper().replace('-', '_'))
+    return request.META.get(meta_name, '').strip() or None
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+class JSONArrayReader(object):
+    """ Iterate over the items of a JSON array read from a file-like object.
+
+        The stream is read by chunks so only the current item is in memory.
+        Raises PayloadTooLarge past `max_size` bytes read or for an item
+        over `max_item_size` characters, ValueError on malformed input. """
+
+    NUMBER_CHARS = '0123456789.eE+-'
+
+    def __init__(self, stream, chunk_size=65536,
+                 max_size=None, max_item_size=None):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.max_item_size = max_item_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.size = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buffer += self.text_decoder.decode(b'', True)
+            return False
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise PayloadTooLarge("Payload over {} bytes".format(
+                self.max_size))
+        self.buffer += self.text_decoder.decode(chunk)
+        return True
+
+    def _peek(self):
+        """ next non-blank character """
+        while True:
+            self.buffer = self.buffer.lstrip()
+            if self.buffer:
+                return self.buffer[0]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON array")
+
+    def _pop(self):
+        char = self._peek()
+        self.buffer = self.buffer[1:]
+        return char
+
+    def _decode_item(self):
+        self._peek()
+        while True:
+            try:
+                item, end = self.decoder.raw_decode(self.buffer)
+            except ValueError:
+                if self.max_item_size is not None \
+                        and len(self.buffer) > self.max_item_size:
+                    raise PayloadTooLarge("Item over {} characters".format(
+                        self.max_item_size))
+                if not self._fill():
+                    raise
+                continue
+            # a number may continue in next chunk (`2.` then `5`)
+            if isinstance(item, (int, float)) \
+                    and not isinstance(item, bool) \
+                    and (end == len(self.buffer)
+                         or self.buffer[end] in self.NUMBER_CHARS) \
+                    and self._fill():
+                continue
+            if self.max_item_size is not None and end > self.max_item_size:
+                raise PayloadTooLarge("Item over {} characters".format(
+                    self.max_item_size))
+            self.buffer = self.buffer[end:]
+            return item
+
+    def __iter__(self):
+        if self._pop() != '[':
+            raise ValueError("Not a JSON array")
+        if self._peek() == ']':
+            return
+        while True:
+            yield self._decode_item()
+            char = self._pop()
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError("Malformed JSON array")
+
+
+def atomic():
+    """ transaction block (commit_on_success before Django 1.6) """
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic()
+    return transaction.commit_on_success()
+
+
+def chunked(iterable, size):
+    """ lists of `size` items from iterable """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def get_test_payload():
     return {'action': 'test',
             'battery': '100',
@@ -46,12 +183,23 @@ def get_test_payload():
             'version': '30'}
 
 
-def test_connection(url, timeout):
+def test_connection(url, timeout, method=None):
+    """ whether server can be reached.
+
+        POST sends a fondaSMS `test` action and expects a successful reply.
+        Other methods (HEAD, GET) are cheaper: any non-5xx answer
+        proves the link is up. """
+    method = (method or settings.CONNECTION_PROBE_METHOD).upper()
     try:
-        req = requests.post(url,
-                           data=get_test_payload(),
-                           timeout=timeout)
-        req.raise_for_status()
+        if method == 'POST':
+            req = requests.post(url,
+                                data=get_test_payload(),
+                                timeout=timeout)
+            req.raise_for_status()
+        else:
+            req = requests.request(method, url, timeout=timeout)
+            if req.status_code >= 500:
+                return False
         return True
     except RequestException:
         pass
@@ -87,7 +235,5 @@ def should_forward(project, request):
     return False
 
 def has_pending_outgoing(project):
-    from isafonda.models import StalledRequest
-    return StalledRequest.objects.filter(
-        project=project,
-        status=StalledRequest.PENDING_DOWNSTREAM).count()
+    from isafonda.pending import pending_index
+    return pending_index.has_pending_downstream(project)
@@ -6,37 +6,92 @@ from __future__ import (unicode_literals, absolute_import,
                         division, print_function)
 import json
 import re
+import uuid
+from collections import OrderedDict
 
 import requests
 from requests.exceptions import RequestException
 
-from django.http import HttpResponse  #, Http404
+from django.conf import settings
+from django.http import HttpResponse, Http404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.shortcuts import get_object_or_404
 
 from isafonda.models import (Project, FondaSMSRequest,
                              StalledRequest)
-from isafonda.utils import should_forward, has_pending_outgoing
+from isafonda.utils import (should_forward, has_pending_outgoing,
+                            idempotency_header, idempotency_key_from,
+                            make_idempotency_key,
+                            JSONArrayReader, PayloadTooLarge, chunked,
+                            atomic)
 from isafonda.connection import conn_status
+from isafonda.fleet import fleet
+from isafonda.latency import latency
+from isafonda.pending import pending_index
+from isafonda.push import push_pending
+from isafonda.stats import queue_stats
 
 
 def home(request):
     text = "Service is running OK.\n"
-    text += "\n".join(["{slug}:\t{name}".format(slug=p.slug,
-                                                name=p.name)
+    text += "\n".join(["{slug}:\t{name}\t{live}; {drain}".format(
+                       slug=p.slug, name=p.name,
+                       live=latency.describe(p, latency.LIVE),
+                       drain=latency.describe(p, latency.DRAIN))
                        for p in Project.objects.all()])
 
     return HttpResponse(text, mimetype='text/plain')
 
 
+def status_dashboard(request):
+    stats = queue_stats()
+    text = ("Queues as of {} (drain rate over last {}s, "
+            "latency over last {}s).\n").format(
+        stats['generated_on'], stats['drain_window'],
+        stats['latency_window'])
+
+    for slug, project in sorted(stats['projects'].items()):
+        text += "\n{slug}:\t{name}\n".format(slug=slug,
+                                             name=project['name'])
+        for status in (StalledRequest.PENDING_UPSTREAM,
+                       StalledRequest.PENDING_DOWNSTREAM):
+            queue = project['queues'][status]
+            if queue['oldest_age'] is None:
+                oldest = "-"
+            else:
+                oldest = "{:.0f}s".format(queue['oldest_age'])
+            text += ("  {label}:\t{depth} pending, oldest {oldest}, "
+                     "drained {rate:.1f}/min\n").format(
+                        label=queue['label'], depth=queue['depth'],
+                        oldest=oldest, rate=queue['drain_rate'])
+            if queue['latency'] is not None:
+                text += ("  \tdelivered in p50 {p50:.1f}s, p95 {p95:.1f}s, "
+                         "p99 {p99:.1f}s ({samples} requests)\n").format(
+                            **queue['latency'])
+
+    return HttpResponse(text, mimetype='text/plain')
+
+
+def status_json(request):
+    return HttpResponse(json.dumps(queue_stats()),
+                        mimetype='application/json')
+
+
 @csrf_exempt
 @require_POST
 def fondasms_handler(request, project_slug):
 
-    project = get_object_or_404(Project, slug=project_slug)
+    try:
+        project = Project.get_cached(project_slug)
+    except Project.DoesNotExist:
+        raise Http404
 
-    fondareq = FondaSMSRequest.from_post(request.POST)
+    fondareq = FondaSMSRequest.from_post(request.POST, request.FILES)
+
+    if fondareq.is_send_status and fondareq.phone_number is not None:
+        fleet.acknowledge(project, fondareq.phone_number,
+                          fondareq.get('status'))
 
     automatic_reply = get_automatic_reply(fondareq, project)
 
@@ -48,15 +103,20 @@ def fondasms_handler(request, project_slug):
                 auto_reply=automatic_reply),
             phone_number=fondareq.phone_number)
 
+    data, headers = fondareq.encoded()
+    headers.update(idempotency_header(fondareq.idempotency_key))
+    timeout = latency.timeout(project, latency.LIVE)
     try:
         req = requests.post(project.url,
-                            data=request.POST,
-                            timeout=project.timeout)
+                            data=data,
+                            headers=headers,
+                            timeout=timeout)
         req.raise_for_status()
-    except RequestException:
+    except RequestException as exp:
+        latency.record_failure(project, latency.LIVE, exp, timeout)
         conn_status.update(project, conn_status.NOT_WORKING)
         if not fondareq.is_outgoing or not has_pending_outgoing(project):
-            cache_request_locally(request, project)
+            cache_request_locally(request, project, fondareq)
         return build_response_with(
             pending_upstream_messages(
                 project,
@@ -65,6 +125,7 @@ def fondasms_handler(request, project_slug):
             phone_number=fondareq.phone_number)
 
     conn_status.update(project, conn_status.WORKING)
+    latency.record_response(project, latency.LIVE, req)
 
     return merge_response_with(
         req,
@@ -85,7 +146,15 @@ def pending_upstream_messages(project,
                                                phone_number=phone_number) + auto
 
 
+EMPTY_RESPONSE = '{{"events": [], "phone_number": {phone_number}}}'
+
+
 def build_response_with(events=[], phone_number=None):
+    if not len(events):
+        return HttpResponse(
+            EMPTY_RESPONSE.format(phone_number=json.dumps(phone_number)),
+            mimetype='application/json')
+
     response = {'events': [],
                 'phone_number': phone_number}
     if len(events):
@@ -116,8 +185,9 @@ def can_overload_response(response):
         and response.headers.get('content-type') == 'application/json'
 
 
-def cache_request_locally(request, project):
-    StalledRequest.from_upstream(project=project, request=request)
+def cache_request_locally(request, project, fondareq=None):
+    StalledRequest.from_upstream(project=project, request=request,
+                                 fondareq=fondareq)
 
 
 def get_automatic_reply(request, project):
@@ -131,10 +201,87 @@ def get_automatic_reply(request, project):
             'message': project.automatic_reply_text}
 
 
+def route_events(project, events, phone_number, base_key, batch_index):
+    """ (phone_number, events, idempotency_key) for each queue row
+
+        With `project.reply_same_phone`, an event may target a specific
+        phone through its `phone_number`. Otherwise phones only get
+        messages without target: none is set.
+        Rows hold at most `project.max_items` events. """
+    routes = OrderedDict()
+    for event in events:
+        target = None
+        if project.reply_same_phone:
+            target = event.get('phone_number') \
+                if isinstance(event, dict) else None
+            target = target or phone_number or None
+        routes.setdefault(target, []).append(event)
+
+    step = max(1, project.max_items)
+    batches = []
+    for target, items in routes.items():
+        for start in range(0, len(items), step):
+            rows = items[start:start + step]
+            batches.append((target, rows,
+                            make_idempotency_key(base_key, target,
+                                                 batch_index, start)))
+    return batches
+
+
+def forward_stored(project, keys):
+    """ forward rows stored under keys upstream, push the others to phones
+
+        Returns the number of rows left pending. """
+    failed_to_send = not project.transfer_upstream
+    nb_left = 0
+    targets = set()
+    for chunk in chunked(keys, 500):
+        sreqs = StalledRequest.objects.filter(
+            project=project,
+            status=StalledRequest.PENDING_UPSTREAM,
+            idempotency_key__in=chunk).order_by('id')
+        for sreq in sreqs:
+            if not failed_to_send:
+                # taken by a polling phone meanwhile
+                if not sreq.claim():
+                    continue
+                if forward_upstream(project, sreq.payload,
+                                    sreq.phone_number, sreq.idempotency_key):
+                    continue
+                # back in queue. Don't wait on a dead link for every row
+                failed_to_send = True
+                sreq.unclaim(sreq.payload, error="Not forwarded upstream")
+            nb_left += 1
+            targets.add(sreq.phone_number)
+
+    # rows were flagged before being committed: flag them again.
+    # and don't wait for phones to poll
+    for target in targets:
+        pending_index.mark(pending_index.UPSTREAM, project, target)
+        push_pending(project, target)
+    return nb_left
+
+
+def forward_upstream(project, events, phone_number, key):
+    if phone_number is not None:
+        params = {'phone_number': re.sub(r'^223', '', phone_number)}
+    else:
+        params = {}
+    try:
+        req = requests.post(project.upstream_url,
+                            data=json.dumps(events),
+                            headers=idempotency_header(key),
+                            timeout=project.timeout,
+                            params=params)
+        req.raise_for_status()
+    except RequestException:
+        return False
+    return True
+
+
 @csrf_exempt
 @require_POST
 def external_events_handler(request, project_slug):
-    failed_to_send = False
     print("project: {}".format(project_slug))
     project = get_object_or_404(Project, slug=project_slug)
 
@@ -143,30 +290,48 @@ def external_events_handler(request, project_slug):
 
     secret = request.GET.get('secret', '').strip()
     phone_number = request.GET.get('phone_number', None)
-    events = json.loads(request.read())
 
     if project.transfer_upstream_secret \
         and project.transfer_upstream_secret != secret:
         return HttpResponse("Access Forbidden", status=403)
 
-    if project.transfer_upstream:
-        if phone_number is not None:
-            params = {'phone_number': re.sub(r'^223', '', phone_number)}
-        else:
-            params = {}
-        try:
-            req = requests.post(project.upstream_url,
-                                data=json.dumps(events),
-                                timeout=project.timeout,
-                                params=params)
-            req.raise_for_status()
-        except RequestException:
-            failed_to_send = True
-
-    if failed_to_send or not project.transfer_upstream:
-        StalledRequest.from_downstream(project=project,
-                                       events=events,
-                                       phone_number=phone_number)
+    # events are parsed and stored by batches so that large pushes
+    # (campaigns) are never held in memory at once. Nothing is stored
+    # nor forwarded unless the whole list is valid.
+    # Only requests identified by sender are deduplicated; others get
+    # a unique key to find the rows back.
+    sender_key = idempotency_key_from(request)
+    base_key = sender_key or uuid.uuid4().hex
+    reader = JSONArrayReader(
+        request,
+        max_size=settings.EXTERNAL_EVENTS_MAX_SIZE,
+        max_item_size=settings.EXTERNAL_EVENTS_MAX_ITEM_SIZE)
+    stored_keys = []
+
+    try:
+        with atomic():
+            for batch_index, events in enumerate(
+                    chunked(reader, settings.EXTERNAL_EVENTS_BATCH_SIZE)):
+                batches = route_events(project, events, phone_number,
+                                       base_key, batch_index)
+                # sender retried a request we (partly) got
+                known = StalledRequest.known_keys(
+                    project, [key for _, _, key in batches],
+                    (StalledRequest.PENDING_UPSTREAM,
+                     StalledRequest.SENT_UPSTREAM)) \
+                    if sender_key else set()
+                batches = [batch for batch in batches
+                           if batch[2] not in known]
+                StalledRequest.bulk_from_downstream(project, batches)
+                stored_keys += [key for _, _, key in batches]
+    except PayloadTooLarge:
+        return HttpResponse("Request too large.", status=413)
+    except ValueError:
+        return HttpResponse("Malformed events list.", status=400)
+
+    nb_cached = forward_stored(project, stored_keys)
+
+    if nb_cached:
         return HttpResponse("Request cached for later delivery.",
                             status=201)
 
@@ -27,6 +27,11 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "isafonda.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+from django.conf import settings
+if settings.CONNECTION_WARM_UP:
+    from isafonda.connection import conn_status
+    conn_status.warm_up(background=True)
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)